@@ -1,5 +1,6 @@
 #Standard Imports
 import logging
+import time
 from typing import Union
 
 #Discord Imports
@@ -15,6 +16,45 @@ log = logging.getLogger("red.oranges_based")
 
 BaseCog = getattr(commands, "Cog", object)
 
+class ReplyThrottle:
+    """
+    Decides which triggers get a reply
+
+    Each channel gets at most one reply per cooldown, any more triggers inside that window are coalesced into the reply
+    already sent. A token bucket caps replies across every channel, so a wave of memes in many channels at once can't
+    eat the bot's shared rate limits either
+    """
+    def __init__(self, cooldown: float = 10, replies_per_minute: int = 30):
+        self.cooldown = cooldown
+        self.set_rate(replies_per_minute)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        # channel id -> time.monotonic() the channel may be replied to again
+        self.next_reply = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.capped = 0
+
+    def set_rate(self, replies_per_minute: int):
+        self.rate = replies_per_minute / 60
+        # Allow a few replies back to back, up to ten seconds' worth
+        self.burst = max(1, replies_per_minute // 6)
+
+    def allow(self, channel_id: int) -> bool:
+        now = time.monotonic()
+        if now < self.next_reply.get(channel_id, 0):
+            self.coalesced += 1
+            return False
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            self.capped += 1
+            return False
+        self.tokens -= 1
+        self.next_reply[channel_id] = now + self.cooldown
+        self.sent += 1
+        return True
+
 class Based(BaseCog):
     """
     Connector that will integrate with any database using the latest tg schema, provides utility functionality
@@ -22,28 +62,45 @@ class Based(BaseCog):
     def __init__(self, bot):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=672261474290237490, force_registration=True)
-        self.visible_config = ["active_channels"]
+        self.visible_config = ["active_channels", "cooldown_seconds", "max_replies_per_minute"]
 
         default_config = {
-            "active_channels": []
+            "active_channels": [],
+            # One reply per channel per cooldown, and at most this many replies a minute across all channels
+            "cooldown_seconds": 10,
+            "max_replies_per_minute": 30,
         }
 
         self.config.register_global(**default_config)
-    
-        self.channel_map = None
+
+        # Ids of the channels we respond in, None until the config has been read once
+        self.active_channels = None
+        self.throttle = ReplyThrottle()
 
     async def load_config(self):
-        if not self.channel_map:
-            self.channel_map = await self.config.active_channels()
+        if self.active_channels is None:
+            settings = await self.config.all()
+            self.throttle = ReplyThrottle(settings["cooldown_seconds"], settings["max_replies_per_minute"])
+            self.active_channels = {int(channel) for channel in settings["active_channels"] if str(channel).isdigit()}
+
+    def is_trigger(self, message):
+        """
+        Does this message get a reply, cheapest checks first as this runs for every message the bot sees
+        """
+        if message.channel.id not in self.active_channels:
+            return False
+        if message.author.id == self.bot.user.id:
+            return False
+        # Only lower the start of the message, not all of it
+        return message.content[:5].lower() == 'based'
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        await self.load_config()
+        if self.active_channels is None:
+            await self.load_config()
 
-        if message.author == self.bot.user:
-            return
-        if str(message.channel.id) in self.channel_map and message.content.lower().startswith('based'):
-                await message.channel.send('Based on what?')
+        if self.is_trigger(message) and self.throttle.allow(message.channel.id):
+            await message.channel.send('Based on what?')
 
 
     @commands.guild_only()
@@ -70,9 +127,11 @@ class Based(BaseCog):
         """
         await self.load_config()
         try:
-            if channel not in self.channel_map:
-                self.channel_map.append(channel)
-            await self.config.active_channels.set(self.channel_map)
+            channel_id = int(channel)
+            async with self.config.active_channels() as channels:
+                if str(channel_id) not in channels:
+                    channels.append(str(channel_id))
+            self.active_channels.add(channel_id)
             await ctx.send(f"Channel added")
 
         except (ValueError, KeyError, AttributeError):
@@ -81,17 +140,51 @@ class Based(BaseCog):
     @config.command()
     async def remove_channel(self, ctx, channel: str):
         """
-        Add a channel we respond in
+        Remove a channel we respond in
         """
         await self.load_config()
         try:
-            self.channel_map.remove(channel)
-            await self.config.active_channels.set(self.channel_map)
+            channel_id = int(channel)
+            async with self.config.active_channels() as channels:
+                channels.remove(str(channel_id))
+            self.active_channels.discard(channel_id)
             await ctx.send(f"Channel removed")
 
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem adding the channel")
 
+    @config.command()
+    async def cooldown(self, ctx, seconds: int):
+        """
+        Set how long after a reply a channel gets no more replies, triggers in that time are folded into the one reply
+        """
+        await self.load_config()
+        try:
+            if seconds < 0:
+                return await ctx.send("The cooldown can't be negative")
+            await self.config.cooldown_seconds.set(seconds)
+            self.throttle.cooldown = seconds
+            await ctx.send(f"Each channel now gets at most one reply every {seconds} seconds")
+
+        except (ValueError, KeyError, AttributeError):
+            await ctx.send("There was a problem setting the cooldown")
+
+    @config.command()
+    async def max_replies(self, ctx, per_minute: int):
+        """
+        Set how many replies a minute we send across all channels
+        """
+        await self.load_config()
+        try:
+            if per_minute < 1:
+                return await ctx.send("That would stop all replies, remove the channels instead")
+            await self.config.max_replies_per_minute.set(per_minute)
+            self.throttle.set_rate(per_minute)
+            await ctx.send(f"At most {per_minute} replies a minute will be sent")
+
+        except (ValueError, KeyError, AttributeError):
+            await ctx.send("There was a problem setting the reply limit")
+
     @config.command()
     async def current(self, ctx):
         """
@@ -107,4 +200,6 @@ class Based(BaseCog):
                 embed.add_field(name=f"{k}:",value=v,inline=False)
             else:
                 embed.add_field(name=f"{k}:",value="`redacted`",inline=False)
+        embed.add_field(name="replies:", value=f"{self.throttle.sent} sent, {self.throttle.coalesced} coalesced into a recent reply,"
+            f" {self.throttle.capped} dropped by the global limit", inline=False)
         await ctx.send(embed=embed)
@@ -0,0 +1,91 @@
+"""
+Times the Based on_message listener per message, against the old listener that read the config list and scanned it
+for every message
+
+Run from the repository root with redbot installed: python -m based.tests.onmessagebench
+"""
+
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from ..based import Based, ReplyThrottle
+
+MESSAGES = 200000
+ACTIVE_CHANNELS = 20
+SEEN_CHANNELS = 500
+
+async def send(content):
+    pass
+
+class FakeConfig:
+    """
+    Stands in for Red's Config, a read of the channel list costs a coroutine like the real one does at the very least
+    """
+    def __init__(self, channels):
+        self.channels = channels
+
+    async def active_channels(self):
+        await asyncio.sleep(0)
+        return list(self.channels)
+
+    async def all(self):
+        await asyncio.sleep(0)
+        return {"active_channels": list(self.channels), "cooldown_seconds": 10, "max_replies_per_minute": 30}
+
+class OldBased:
+    """
+    The listener as it was, for comparison
+    """
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.config = config
+        self.channel_map = None
+
+    async def load_config(self):
+        if not self.channel_map:
+            self.channel_map = await self.config.active_channels()
+
+    async def on_message(self, message):
+        await self.load_config()
+
+        if message.author == self.bot.user:
+            return
+        if str(message.channel.id) in self.channel_map and message.content.lower().startswith('based'):
+                await message.channel.send('Based on what?')
+
+def make_messages(bot_user, channel_ids):
+    contents = ["based", "Based and redpilled", "lol", "x" * 1500, "what is this"]
+    users = [bot_user] + [SimpleNamespace(id=i, bot=False) for i in range(1, 50)]
+    channels = [SimpleNamespace(id=channel_id, send=send) for channel_id in channel_ids]
+    return [SimpleNamespace(author=random.choice(users), channel=random.choice(channels), content=random.choice(contents))
+        for _ in range(MESSAGES)]
+
+async def time_listener(listener, messages):
+    start = time.perf_counter()
+    for message in messages:
+        await listener(message)
+    return (time.perf_counter() - start) / len(messages)
+
+def make_new(bot, channels):
+    based = Based.__new__(Based)
+    based.bot = bot
+    based.config = FakeConfig(channels)
+    based.active_channels = None
+    based.throttle = ReplyThrottle()
+    return based
+
+async def main():
+    random.seed(13)
+    bot = SimpleNamespace(user=SimpleNamespace(id=0, bot=True))
+    channel_ids = [100000000000000000 + i for i in range(SEEN_CHANNELS)]
+    active = [str(channel_id) for channel_id in channel_ids[:ACTIVE_CHANNELS]]
+    messages = make_messages(bot.user, channel_ids)
+
+    for label, channels in (("no active channels", []), (f"{ACTIVE_CHANNELS} active channels", active)):
+        old = await time_listener(OldBased(bot, FakeConfig(channels)).on_message, messages)
+        new = await time_listener(make_new(bot, channels).on_message, messages)
+        print(f"{label}: old {old * 1e6:.2f}us/message, new {new * 1e6:.2f}us/message ({1 / new:,.0f} messages/second), {old / new:.1f}x")
+
+asyncio.run(main())
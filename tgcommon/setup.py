@@ -1,5 +1,5 @@
 
-from setuptools import setup
+import setuptools
 
 setuptools.setup(
     name="tgcommon-oranges",
@@ -10,7 +10,7 @@ setuptools.setup(
     long_description="Common code for the tg cogs connecting to a tg ss13 database",
     long_description_content_type="text", #text/markdown later
     url="https://github.com/optimumtact/orangescogs",
-    packages=['tgcommon'],
+    packages=['tgcommon', 'tgcommon.models'],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,67 @@
+"""
+Small in-memory caches shared by the tg cogs
+"""
+import time
+from collections import OrderedDict
+
+# Returned by get when a key is not cached, so a cached None (a negative result) can be told apart from a miss
+MISSING = object()
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after a fixed number of seconds
+
+    Keeps hit/miss counters so the owner can see whether it is earning its keep
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            return entry[1]
+
+    def pop_where(self, predicate):
+        """
+        Drop every entry whose (key, value) matches the predicate, for invalidations that can't be done by key
+        """
+        for key in [key for key, (_, value) in self._data.items() if predicate(key, value)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total:
+            return self.hits / total
+        return 0.0
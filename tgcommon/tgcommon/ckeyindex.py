@@ -0,0 +1,121 @@
+"""
+In-memory index of every ckey in the player table, for prefix and "did you mean" lookups without LIKE scans
+"""
+import bisect
+import heapq
+import time
+
+# Sorts after every character a ckey can contain, prefix + PREFIX_END bounds the range of ckeys starting with prefix
+PREFIX_END = "\uffff"
+
+def shared_prefix_length(a: str, b: str) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+class CkeyIndex:
+    """
+    Sorted array of lowercase ckeys
+
+    The array is walked like a trie for fuzzy search: neighbouring ckeys share prefixes, so the edit distance rows computed
+    for a shared prefix are reused, and once every entry in a row is over the distance limit all ckeys under that prefix
+    are skipped with a bisect
+
+    loaded_until is the latest lastseen the index has been filled up to, refresh from there to pick up new players, and
+    refreshed is when (time.monotonic) that last happened
+
+    add and similar are CPU bound and meant to be run in worker threads. add swaps in a new array rather than changing the
+    one a search may be walking
+    """
+    def __init__(self):
+        self.ckeys = []
+        self._members = set()
+        self.loaded_until = None
+        self.refreshed = None
+
+    def __len__(self):
+        return len(self.ckeys)
+
+    def __contains__(self, ckey):
+        return ckey.lower() in self._members
+
+    def add(self, rows):
+        """
+        Add (ckey, lastseen) rows, ckeys already in the index are ignored
+        """
+        new = []
+        for ckey, lastseen in rows:
+            ckey = ckey.lower()
+            if ckey not in self._members:
+                self._members.add(ckey)
+                new.append(ckey)
+            if self.loaded_until is None or lastseen > self.loaded_until:
+                self.loaded_until = lastseen
+        if len(new) > 64:
+            self.ckeys = sorted(self.ckeys + new)
+        elif new:
+            ckeys = list(self.ckeys)
+            for ckey in new:
+                bisect.insort(ckeys, ckey)
+            self.ckeys = ckeys
+        self.refreshed = time.monotonic()
+        return len(new)
+
+    def starting_with(self, prefix: str, limit: int = 10) -> list:
+        """
+        The first limit ckeys (alphabetically) that start with prefix
+        """
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.ckeys, prefix)
+        end = bisect.bisect_left(self.ckeys, prefix + PREFIX_END, start)
+        return self.ckeys[start:min(end, start + limit)]
+
+    def similar(self, ckey: str, max_distance: int = 2, limit: int = 5) -> list:
+        """
+        The limit ckeys closest to ckey by Levenshtein distance, at most max_distance edits away, closest first
+        """
+        query = ckey.lower()
+        size = len(query)
+        # Distances past the limit are all the same to us, capping them means cells outside the diagonal band never change
+        too_far = max_distance + 1
+        ckeys = self.ckeys
+        # rows[depth] is the distance row for the first depth characters of the current ckey
+        rows = [[min(j, too_far) for j in range(size + 1)]]
+        previous = ""
+        matches = []
+        i = 0
+        while i < len(ckeys):
+            candidate = ckeys[i]
+            del rows[min(shared_prefix_length(previous, candidate), len(rows) - 1) + 1:]
+            previous = candidate
+            for depth in range(len(rows) - 1, len(candidate)):
+                character = candidate[depth]
+                above = rows[-1]
+                row = [too_far] * (size + 1)
+                row[0] = best = min(depth + 1, too_far)
+                # Only cells within max_distance of the diagonal can be under the limit
+                for j in range(max(1, depth + 1 - max_distance), min(size, depth + 1 + max_distance) + 1):
+                    # min() of the three moves, spelled out because this is the hot loop
+                    cost = above[j - 1] + (query[j - 1] != character)
+                    if above[j] + 1 < cost:
+                        cost = above[j] + 1
+                    if row[j - 1] + 1 < cost:
+                        cost = row[j - 1] + 1
+                    if cost > too_far:
+                        cost = too_far
+                    row[j] = cost
+                    if cost < best:
+                        best = cost
+                rows.append(row)
+                if best > max_distance:
+                    # No ckey starting with this prefix can get back under the limit
+                    i = bisect.bisect_left(ckeys, candidate[:depth + 1] + PREFIX_END, i + 1)
+                    break
+            else:
+                distance = rows[-1][-1]
+                if distance <= max_distance:
+                    matches.append((distance, candidate))
+                i += 1
+        return [candidate for _, candidate in heapq.nsmallest(limit, matches)]
@@ -0,0 +1,68 @@
+"""
+Models that map to database tables in tgstation database schema
+TODO: investigate SQL alchemy for this?
+"""
+import datetime
+import ipaddress
+from collections import namedtuple
+from operator import itemgetter
+from typing import NamedTuple, Optional
+
+BaseLink = namedtuple('DiscordLink', 'id, ckey, discord_id, timestamp, one_time_token, valid')
+# Picks the link fields out of a dict row in field order
+link_fields = itemgetter(*BaseLink._fields)
+
+class DiscordLink(BaseLink):
+    # No per instance __dict__, a link is just its tuple
+    __slots__ = ()
+
+    @classmethod
+    def from_db_record(cls, record):
+        """
+        Build a link from a dict row, any columns that aren't link fields are ignored
+        """
+        return cls._make(link_fields(record))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build links from tuple rows whose columns are in field order (id, ckey, discord_id, timestamp, one_time_token, valid)
+        """
+        return list(map(cls._make, rows))
+
+    @property
+    def validity(self):
+        if self.valid > 0:
+            return True
+        return False
+
+
+class Player(NamedTuple):
+    """
+    A player's identity and role time, everything verification needs to decide on a user
+    """
+    ckey: str
+    first: datetime.datetime
+    last: datetime.datetime
+    cid: str
+    ip: ipaddress.IPv4Address
+    join: Optional[datetime.date]
+    living_time: int
+    ghost_time: int
+
+    @classmethod
+    def from_db_record(cls, record):
+        return cls(
+            record['ckey'],
+            record['firstseen'],
+            record['lastseen'],
+            record['computerid'],
+            ipaddress.IPv4Address(record['ip']), #IP's are stored as a 32 bit integer, converting it for readability
+            record['accountjoindate'],
+            int(record['living_time']),
+            int(record['ghost_time']),
+        )
+
+    @property
+    def total_time(self):
+        return self.living_time + self.ghost_time
@@ -320,8 +320,8 @@ game_round = Table("round", metadata,
     Column("id", INTEGER(11), nullable = False, autoincrement = True),
     Column("initialize_datetime", DATETIME(), nullable = False),
     Column("start_datetime", DATETIME(), default = None),
-    Column("shutdown_datetime", default = None),
-    Column("end_datetime", default = None),
+    Column("shutdown_datetime", DATETIME(), default = None),
+    Column("end_datetime", DATETIME(), default = None),
     Column("server_ip", INTEGER(10, unsigned = True), nullable = False),
     Column("server_port", SMALLINT(5, unsigned = True), nullable = False),
     Column("commit_hash", CHAR(40), default = None),
@@ -417,10 +417,14 @@ ticket = Table("ticket", metadata,
 discord_links = Table("discord_links", metadata,
     Column("id", INTEGER(11, unsigned = True), nullable = False, autoincrement = True),
     Column("ckey", VARCHAR(32), nullable = False),
-    Column("discord_id", BIGINT(20), nullable = TRUE, default= None),
+    Column("discord_id", BIGINT(20), nullable = True, default= None),
     Column("timestamp", DATETIME(), nullable = False),
     Column("one_time_token", VARCHAR(100), nullable=False),
     Column("valid", BOOLEAN(), nullable=False, default=False),
 
-    PrimaryKeyConstraint("id")
+    PrimaryKeyConstraint("id"),
+
+    Index("idx_discord_links_token", "one_time_token"),
+    Index("idx_discord_links_discord_id_time", "discord_id", "timestamp"),
+    Index("idx_discord_links_ckey_time", "ckey", "timestamp")
 )
@@ -0,0 +1,118 @@
+"""
+Compares a live database against the tg schema in tgcommon.models.tgschema, from two bulk information_schema reads
+
+Reports missing tables, missing columns, columns whose type differs and indexes the database doesn't have
+"""
+import time
+from collections import namedtuple
+
+from sqlalchemy.dialects import mysql
+from sqlalchemy.types import NullType
+
+from .models import tgschema
+from .util import unprefixed_table
+
+# Kinds of difference
+MISSING_TABLE = "missing table"
+MISSING_COLUMN = "missing column"
+TYPE_MISMATCH = "type mismatch"
+MISSING_INDEX = "missing index"
+
+# name is the column or index (None for a missing table), expected and actual describe the column type or index columns
+Drift = namedtuple('Drift', 'kind, table, name, expected, actual')
+
+COLUMNS_SQL = ("SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name, DATA_TYPE AS data_type, COLUMN_TYPE AS column_type, "
+    "CHARACTER_MAXIMUM_LENGTH AS max_length FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE()")
+INDEXES_SQL = ("SELECT TABLE_NAME AS table_name, INDEX_NAME AS index_name, COLUMN_NAME AS column_name FROM information_schema.STATISTICS "
+    "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX")
+
+DIALECT = mysql.dialect()
+
+# information_schema DATA_TYPE values that a SQLAlchemy type name is stored as, MariaDB keeps JSON in a longtext
+EQUIVALENT_TYPES = {"integer": ("int",), "bool": ("tinyint",), "boolean": ("tinyint",), "json": ("json", "longtext")}
+
+class SchemaReport:
+    """
+    The differences between one database and the tg schema, and what they mean for the statements run against it
+    """
+    def __init__(self, drifts: list):
+        self.drifts = drifts
+        # time.monotonic() of the check, so callers can decide when it's stale
+        self.checked = time.monotonic()
+        self._missing_tables = {drift.table for drift in drifts if drift.kind == MISSING_TABLE}
+        self._missing_columns = {(drift.table, drift.name) for drift in drifts if drift.kind == MISSING_COLUMN}
+
+    def __bool__(self):
+        return bool(self.drifts)
+
+    def unusable(self, columns) -> list:
+        """
+        The (table, column) pairs out of columns that the database doesn't have, a statement using any of them would fail
+        """
+        return sorted((table, column) for table, column in columns
+            if table in self._missing_tables or (table, column) in self._missing_columns)
+
+    def by_kind(self, kind: str) -> list:
+        return [drift for drift in self.drifts if drift.kind == kind]
+
+def declared_type(column):
+    """
+    (compiled type, data type, unsigned, length) the tg schema declares for a column, None if it declares no type
+    """
+    if isinstance(column.type, NullType):
+        return None
+    compiled = column.type.compile(dialect=DIALECT)
+    data_type = compiled.lower().split("(")[0].split(" ")[0]
+    length = getattr(column.type, "length", None) if data_type in ("varchar", "char") else None
+    return compiled, data_type, "UNSIGNED" in compiled, length
+
+def type_matches(declared, row) -> bool:
+    _, data_type, unsigned, length = declared
+    if row["data_type"].lower() not in EQUIVALENT_TYPES.get(data_type, (data_type,)):
+        return False
+    if unsigned != ("unsigned" in row["column_type"].lower()):
+        return False
+    if length is not None and row["max_length"] is not None and int(row["max_length"]) != length:
+        return False
+    return True
+
+def check(column_rows, index_rows, prefix: str = "", metadata=tgschema.metadata) -> SchemaReport:
+    """
+    Diff the COLUMNS_SQL and INDEXES_SQL results for a database against the schema, for the tables under this prefix
+    """
+    columns = {}
+    for row in column_rows:
+        name = unprefixed_table(row["table_name"], prefix)
+        if name is not None:
+            columns.setdefault(name, {})[row["column_name"].lower()] = row
+    indexes = {}
+    for row in index_rows:
+        name = unprefixed_table(row["table_name"], prefix)
+        if name is not None:
+            indexes.setdefault(name, {}).setdefault(row["index_name"], []).append(row["column_name"].lower())
+
+    drifts = []
+    for name, table in sorted(metadata.tables.items()):
+        live_columns = columns.get(name)
+        if live_columns is None:
+            drifts.append(Drift(MISSING_TABLE, name, None, None, None))
+            continue
+
+        for column in table.columns:
+            declared = declared_type(column)
+            row = live_columns.get(column.name.lower())
+            if row is None:
+                drifts.append(Drift(MISSING_COLUMN, name, column.name, declared[0] if declared else None, None))
+            elif declared is not None and not type_matches(declared, row):
+                drifts.append(Drift(TYPE_MISMATCH, name, column.name, declared[0], row["column_type"]))
+
+        # An index is there if some live index leads with the same columns, whatever it is called
+        live_indexes = list(indexes.get(name, {}).values())
+        wanted = [(index.name, [column.name.lower() for column in index.columns]) for index in table.indexes]
+        if table.primary_key.columns:
+            wanted.append(("PRIMARY", [column.name.lower() for column in table.primary_key.columns]))
+        for index_name, index_columns in wanted:
+            if not any(live[:len(index_columns)] == index_columns for live in live_indexes):
+                drifts.append(Drift(MISSING_INDEX, name, index_name, ", ".join(index_columns), None))
+
+    return SchemaReport(drifts)
@@ -0,0 +1,64 @@
+"""
+Row counts and on disk sizes of the tg schema's tables
+
+Estimates for every table come from information_schema.TABLES in one query, exact counts scan the table and are only
+run when asked for
+"""
+import json
+from collections import namedtuple
+
+from sqlalchemy import func, select, table
+from sqlalchemy.dialects import mysql
+
+from .models import tgschema
+from .util import unprefixed_table
+
+# rows is the server's estimate (exact for MyISAM, a sample for InnoDB) unless exact is set
+TableStats = namedtuple('TableStats', 'table, rows, exact, data_bytes, index_bytes')
+
+ESTIMATES_SQL = ("SELECT TABLE_NAME AS table_name, TABLE_ROWS AS table_rows, DATA_LENGTH AS data_length, INDEX_LENGTH AS index_length "
+    "FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+
+def from_estimates(rows, prefix: str = "") -> dict:
+    """
+    TableStats for each tg schema table in the ESTIMATES_SQL result, keyed by unprefixed table name
+    """
+    stats = {}
+    for row in rows:
+        name = unprefixed_table(row["table_name"], prefix)
+        if name not in tgschema.metadata.tables:
+            continue
+        stats[name] = TableStats(name, int(row["table_rows"] or 0), False, int(row["data_length"] or 0), int(row["index_length"] or 0))
+    return stats
+
+def count_sql(name: str, prefix: str = "") -> str:
+    """
+    Exact row count of a tg schema table, the result has one column, rows
+    """
+    return str(select(func.count().label("rows")).select_from(table(f"{prefix}{name}")).compile(dialect=mysql.dialect()))
+
+def with_exact_count(stats: TableStats, rows) -> TableStats:
+    return stats._replace(rows=int(rows), exact=True)
+
+def human_bytes(size: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+def describe(stats: dict) -> list:
+    """
+    One line per table, largest on disk first, and a total
+    """
+    lines = [f"{'table':<28} {'rows':>14} {'data':>10} {'indexes':>10}"]
+    ordered = sorted(stats.values(), key=lambda entry: entry.data_bytes + entry.index_bytes, reverse=True)
+    for entry in ordered:
+        rows = f"{entry.rows:,}" if entry.exact else f"~{entry.rows:,}"
+        lines.append(f"{entry.table:<28} {rows:>14} {human_bytes(entry.data_bytes):>10} {human_bytes(entry.index_bytes):>10}")
+    lines.append(f"{'total':<28} {'':>14} {human_bytes(sum(entry.data_bytes for entry in ordered)):>10}"
+        f" {human_bytes(sum(entry.index_bytes for entry in ordered)):>10}")
+    return lines
+
+def to_json(stats: dict) -> str:
+    return json.dumps({name: entry._asdict() for name, entry in sorted(stats.items())}, indent=2)
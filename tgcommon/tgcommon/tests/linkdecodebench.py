@@ -0,0 +1,41 @@
+"""
+Times decoding discord_links rows into DiscordLinks, dict rows (DictCursor) unpacked as keywords against tuple rows
+(Cursor) handed to DiscordLink.from_rows
+
+Run with: python -m tgcommon.tests.linkdecodebench
+"""
+
+import datetime
+import timeit
+from collections import namedtuple
+
+from ..models import DiscordLink
+
+ROWS = 100000
+REPEATS = 5
+
+# Unslotted link decoded the old way, for comparison
+OldLink = namedtuple('DiscordLink', 'id, ckey, discord_id, timestamp, one_time_token, valid')
+class OldDiscordLink(OldLink):
+    @classmethod
+    def from_db_record(cls, record):
+        return cls(**record)
+
+now = datetime.datetime.now()
+tuple_rows = [(i, f"ckey{i}", 100000000000000000 + i, now, f"token{i}", 1) for i in range(ROWS)]
+dict_rows = [dict(zip(DiscordLink._fields, row)) for row in tuple_rows]
+
+def best(function):
+    return min(timeit.repeat(function, number=1, repeat=REPEATS))
+
+timings = (
+    ("dict rows, cls(**record)", best(lambda: [OldDiscordLink.from_db_record(row) for row in dict_rows])),
+    ("dict rows, from_db_record", best(lambda: [DiscordLink.from_db_record(row) for row in dict_rows])),
+    ("tuple rows, from_rows", best(lambda: DiscordLink.from_rows(tuple_rows))),
+)
+baseline = timings[0][1]
+for name, seconds in timings:
+    print(f"{name:<28} {seconds * 1000:8.1f}ms {baseline / seconds:5.2f}x")
+
+old, new = OldDiscordLink.from_db_record(dict_rows[0]), DiscordLink.from_rows(tuple_rows[:1])[0]
+print(f"Per link: {old.__sizeof__() + (old.__dict__.__sizeof__() if hasattr(old, '__dict__') else 0)} bytes before, {new.__sizeof__()} bytes with __slots__")
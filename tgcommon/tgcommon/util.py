@@ -1,4 +1,32 @@
 import re
 
+# Anything BYOND strips when turning a key into a ckey
+NON_CKEY_CHARACTERS = re.compile('[^A-Za-z0-9]+')
+# Generous bound on what a one time token from the game can look like, discord_links.one_time_token is a VARCHAR(100)
+TOKEN_SHAPE = re.compile(r"[\w\-' ]{4,100}")
+
 def normalise_to_ckey(key):
-	return re.sub('[^A-Za-z0-9]+', '', key)
+	return NON_CKEY_CHARACTERS.sub('', key)
+
+def normalise_to_ckeys(keys):
+	"""
+	Batch version of normalise_to_ckey, returns a list in the same order
+	"""
+	strip = NON_CKEY_CHARACTERS.sub
+	return [strip('', key) for key in keys]
+
+def looks_like_token(token):
+	"""
+	Could this be a one time token at all, so pasted links, mentions and essays never reach the database
+	"""
+	return TOKEN_SHAPE.fullmatch(token) is not None
+
+def unprefixed_table(name, prefix):
+	"""
+	The tg schema name of a live table under this prefix, None if it isn't under it
+
+	Case insensitive, MySQL on Windows (lower_case_table_names=1) reports an SS13_ prefix back as ss13_
+	"""
+	if not name.lower().startswith(prefix.lower()):
+		return None
+	return name[len(prefix):].lower()
@@ -0,0 +1,69 @@
+"""
+Index advisor, compares the indexes TGDB's statements need against the live database and the tg schema
+"""
+from collections import namedtuple
+
+from tgcommon.models import tgschema
+from tgcommon.util import unprefixed_table
+
+# How well the live indexes serve a statement's filter
+COVERED = "covered"
+PARTIAL = "partial" # An index leads with the filter column, but the rest (usually the ORDER BY) needs a filesort
+FULL_SCAN = "full scan"
+
+IndexAssessment = namedtuple('IndexAssessment', 'statement, table, columns, coverage, index')
+MissingIndex = namedtuple('MissingIndex', 'table, name, columns')
+
+def live_indexes(rows: list, prefix: str) -> dict:
+    """
+    Group information_schema.STATISTICS rows (ordered by index and position) into {table: {index name: [columns]}}
+    with the table prefix stripped
+    """
+    indexes = {}
+    for row in rows:
+        table = unprefixed_table(row["table_name"], prefix)
+        if table is None:
+            continue
+        indexes.setdefault(table, {}).setdefault(row["index_name"], []).append(row["column_name"].lower())
+    return indexes
+
+def assess(statements: dict, indexes: dict) -> list:
+    """
+    Grade every (table, columns) need of every statement against the live indexes
+    """
+    assessments = []
+    for statement in statements.values():
+        for table, columns in statement.needs:
+            wanted = [column.lower() for column in columns]
+            coverage, best = FULL_SCAN, None
+            for name, index_columns in indexes.get(table, {}).items():
+                if index_columns[:len(wanted)] == wanted:
+                    coverage, best = COVERED, name
+                    break
+                if index_columns[0] == wanted[0]:
+                    coverage, best = PARTIAL, name
+            assessments.append(IndexAssessment(statement.name, table, tuple(columns), coverage, best))
+    return assessments
+
+def missing_indexes(statements: dict, indexes: dict) -> list:
+    """
+    Indexes tgschema declares that would serve one of the statements' needs but that the live database lacks,
+    compared by column list rather than name
+    """
+    leading = {}
+    for statement in statements.values():
+        for table, columns in statement.needs:
+            leading.setdefault(table, set()).add(columns[0].lower())
+
+    missing = []
+    for table in sorted(leading):
+        live = list(indexes.get(table, {}).values())
+        for index in sorted(tgschema.metadata.tables[table].indexes, key=lambda index: index.name):
+            columns = [column.name.lower() for column in index.columns]
+            if columns[0] in leading[table] and columns not in live:
+                missing.append(MissingIndex(table, index.name, columns))
+    return missing
+
+def add_index_sql(prefix: str, index: MissingIndex) -> str:
+    columns = ", ".join(f"`{column}`" for column in index.columns)
+    return f"ALTER TABLE `{prefix}{index.table}` ADD INDEX `{index.name}` ({columns})"
@@ -0,0 +1,98 @@
+"""
+In-memory latency metrics for the statements TGDB runs
+"""
+#Standard Imports
+import time
+from collections import deque, namedtuple
+
+SlowQuery = namedtuple('SlowQuery', 'when, name, parameters, acquire, execute, fetch')
+
+class Histogram:
+    """
+    Latency distribution over the most recent samples, percentiles are worked out when they are asked for
+    """
+    def __init__(self, size: int = 2048):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentiles(self, *points):
+        """
+        Return the requested percentiles (0-100) of the recent samples, in seconds
+        """
+        ordered = sorted(self.samples)
+        if not ordered:
+            return [0.0 for _ in points]
+        return [ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] for point in points]
+
+class StatementStats:
+    """
+    Timings for one statement shape, split into waiting for a pooled connection, executing and fetching the rows
+    """
+    def __init__(self):
+        self.acquire = Histogram()
+        self.execute = Histogram()
+        self.fetch = Histogram()
+        self.errors = 0
+
+class Metrics:
+    """
+    Per statement latency histograms plus pool occupancy gauges, since the window was last reset
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.statements = {}
+        # PoolKey -> most connections seen in use at once
+        self.peak_in_use = {}
+        self.window_start = time.time()
+
+    def statement(self, name: str) -> StatementStats:
+        stats = self.statements.get(name)
+        if stats is None:
+            stats = self.statements[name] = StatementStats()
+        return stats
+
+    def observe_pool(self, key, pool):
+        in_use = pool.size - pool.freesize
+        if in_use > self.peak_in_use.get(key, 0):
+            self.peak_in_use[key] = in_use
+
+class SlowQueryLog:
+    """
+    Ring buffer of the most recent statements that took longer than the threshold, plus one EXPLAIN per statement shape
+    """
+    def __init__(self, threshold_ms: float = 250, size: int = 50):
+        self.threshold_ms = threshold_ms
+        self.entries = deque(maxlen=size)
+        # statement name -> rendered EXPLAIN output, None while it is being captured
+        self.explains = {}
+
+    def is_slow(self, seconds: float) -> bool:
+        return seconds * 1000 >= self.threshold_ms
+
+    def record(self, statement, parameters: dict, acquire: float, execute: float, fetch: float):
+        """
+        Store a slow run of statement, with its secret parameters redacted
+        """
+        parameters = {name: "<redacted>" if name in statement.redact else value for name, value in (parameters or {}).items()}
+        self.entries.append(SlowQuery(time.time(), statement.name, parameters, acquire, execute, fetch))
+
+    def needs_explain(self, name: str) -> bool:
+        """
+        True the first time a statement shape is slow, so EXPLAIN is only run once per shape
+        """
+        if name in self.explains:
+            return False
+        self.explains[name] = None
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        self.explains.clear()
@@ -0,0 +1,277 @@
+#Standard Imports
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, namedtuple
+
+import aiomysql
+
+from .resolver import Resolver
+
+log = logging.getLogger("red.oranges_tgdb")
+
+# Identity of a database connection, guilds with the same key share a pool
+# host is the configured name, it is resolved when connecting so a pool can fail over between the name's addresses
+PoolKey = namedtuple('PoolKey', 'host, port, db, user')
+
+# What the supervisor needs to (re)connect a key
+PoolSpec = namedtuple('PoolSpec', 'password, minsize, maxsize')
+
+# Errors that mean we could not reach a server at all, as opposed to a problem with the query
+CONNECTION_ERRORS = (aiomysql.OperationalError, OSError, asyncio.TimeoutError)
+
+# Seconds between health checks of every pool
+HEALTH_INTERVAL = 30
+# Seconds a ping may take before the pool is considered unhealthy
+PING_TIMEOUT = 5
+# Seconds a pool can have every connection out without any query finishing before it is considered stuck
+STUCK_SECONDS = 300
+# Seconds a retired pool's queries get to release their connections before they are closed under them
+RETIRE_TIMEOUT = 60
+# Reconnect backoff, doubling from the base up to the cap, with jitter
+BACKOFF_BASE = 1
+BACKOFF_MAX = 120
+
+def lost_connection(error) -> bool:
+    """
+    Did this error come from losing the server, rather than the server refusing the statement (a deadlock, a lock wait)
+    """
+    if isinstance(error, aiomysql.OperationalError):
+        # Client side error codes (can't connect, server gone away, lost connection) start at 2000, the server's are below
+        return bool(error.args) and isinstance(error.args[0], int) and error.args[0] >= 2000
+    return isinstance(error, CONNECTION_ERRORS)
+
+class PoolRegistry:
+    """
+    Holds one aiomysql pool per distinct database the bot talks to
+
+    Keys are registered with the details needed to connect, and a background supervisor (see supervise) connects them,
+    pings them periodically and reconnects them with exponential backoff when they fail. Callers never connect
+    themselves, they wait a bounded time for the key to be healthy.
+
+    Pools are swapped atomically on reconnect, the pool being replaced is only closed once the queries already running
+    on it have released their connections, or RETIRE_TIMEOUT seconds have passed and they are taken to be stuck
+    """
+    def __init__(self):
+        self._pools = {}
+        self._specs = {}
+        self._locks = {}
+        self._healthy = {}
+        self._failures = Counter()
+        self._next_attempt = {}
+        # Set to make the supervisor look at the pools now instead of at the next interval
+        self._wake = asyncio.Event()
+        # Statements run against each pool, to show how reads are split between primaries and replicas
+        self.query_counts = Counter()
+        self.resolver = Resolver()
+        # PoolKey -> address the current pool connected to
+        self.addresses = {}
+        # PoolKey -> time.monotonic() a query or ping last finished on its pool
+        self.last_success = {}
+        # Called with the key every time a pool is (re)connected, so the owner can warm anything that depends on it
+        self.on_connect = None
+
+    def __contains__(self, key):
+        return key in self._pools
+
+    def get(self, key: PoolKey):
+        return self._pools.get(key)
+
+    def items(self):
+        return list(self._pools.items())
+
+    def record_query(self, key: PoolKey):
+        self.query_counts[key] += 1
+
+    def record_success(self, key: PoolKey):
+        self.last_success[key] = time.monotonic()
+
+    def _lock_for(self, key: PoolKey):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def _health(self, key: PoolKey) -> asyncio.Event:
+        event = self._healthy.get(key)
+        if event is None:
+            event = self._healthy[key] = asyncio.Event()
+        return event
+
+    def register(self, key: PoolKey, password: str, minsize: int, maxsize: int):
+        """
+        Record how to connect to this key, the supervisor connects it if it is not already
+        """
+        spec = PoolSpec(password, minsize, maxsize)
+        if self._specs.get(key) == spec:
+            return
+        self._specs[key] = spec
+        self._health(key)
+        self._wake.set()
+
+    def is_healthy(self, key: PoolKey) -> bool:
+        return key in self._pools and self._health(key).is_set()
+
+    def mark_unhealthy(self, key: PoolKey):
+        """
+        Report that a query could not reach this server, it is skipped until the supervisor sees it answer a ping again
+        """
+        self._health(key).clear()
+        self._wake.set()
+
+    async def wait_for_pool(self, key: PoolKey, timeout: float):
+        """
+        Return the pool for this key once it is healthy, or None if that doesn't happen within timeout seconds
+        """
+        event = self._health(key)
+        if not event.is_set():
+            self._wake.set()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._pools.get(key)
+
+    async def _create(self, key: PoolKey, spec: PoolSpec):
+        """
+        Connect a pool to the first address of the key's host that answers
+        """
+        error = None
+        for address in await self.resolver.resolve(key.host, key.port):
+            log.info(f"Creating pool for {key.user}@{key.host}({address}):{key.port}/{key.db}, size {spec.minsize}-{spec.maxsize}")
+            try:
+                # Establish a connection with the database, recycle connections every 300 seconds
+                # autocommit so reads never hold a snapshot open and single writes need no commit round trip, transactions BEGIN explicitly
+                pool = await aiomysql.create_pool(host=address, port=key.port, db=key.db, user=key.user, password=spec.password,
+                    minsize=spec.minsize, maxsize=spec.maxsize, connect_timeout=5, pool_recycle=300, autocommit=True)
+            except CONNECTION_ERRORS as e:
+                log.warning(f"Could not connect to {key.host} at {address}, trying its next address")
+                self.resolver.demote(key.host, address)
+                error = e
+                continue
+            self.addresses[key] = address
+            return pool
+        raise error or OSError(f"{key.host} did not resolve to any addresses")
+
+    async def replace(self, key: PoolKey):
+        """
+        Build a fresh pool for this registered key and swap it in, then retire the old one
+        """
+        async with self._lock_for(key):
+            pool = await self._create(key, self._specs[key])
+            old = self._pools.get(key)
+            self._pools[key] = pool
+            self._failures.pop(key, None)
+            self._next_attempt.pop(key, None)
+            self.record_success(key)
+            self._health(key).set()
+        if self.on_connect is not None:
+            self.on_connect(key)
+
+        if old is not None:
+            # In the background, a pool replaced for being stuck may take a while to give its connections back
+            asyncio.get_event_loop().create_task(self._retire(old))
+        return pool
+
+    async def discard(self, key: PoolKey):
+        """
+        Forget this key and close its pool, if it has one
+        """
+        async with self._lock_for(key):
+            pool = self._pools.pop(key, None)
+            self.addresses.pop(key, None)
+            self._specs.pop(key, None)
+            self._failures.pop(key, None)
+            self._next_attempt.pop(key, None)
+            self.last_success.pop(key, None)
+            self._health(key).clear()
+        if pool is not None:
+            await self._retire(pool)
+
+    async def close_all(self):
+        for key in set(self._specs) | set(self._pools):
+            await self.discard(key)
+
+    async def _retire(self, pool):
+        # close() only stops new acquires, connections still in use are closed as they are released
+        pool.close()
+        try:
+            await asyncio.wait_for(pool.wait_closed(), RETIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Whatever still holds a connection is waiting on a server that isn't answering
+            pool.terminate()
+
+    async def supervise(self):
+        """
+        Run forever keeping every registered pool connected, started as a background task by the cog
+        """
+        while True:
+            # Cleared before the checks, so a wake up requested while they run is not lost
+            self._wake.clear()
+            keys = list(self._specs)
+            if keys:
+                await asyncio.gather(*(self._check(key) for key in keys))
+
+            # Sleep until the next interval, or sooner if a reconnect is due or someone is waiting on a pool
+            delay = HEALTH_INTERVAL
+            if self._next_attempt:
+                delay = max(0, min(delay, min(self._next_attempt.values()) - time.monotonic()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, key: PoolKey):
+        pool = self._pools.get(key)
+        if pool is not None:
+            try:
+                if pool.freesize == 0 and pool.size == pool.maxsize:
+                    # Every connection is out, a ping through the pool would queue behind them. Busy is fine, but not if
+                    # nothing has finished for a long time, those queries are stuck on a server that stopped answering
+                    if time.monotonic() - self.last_success.get(key, 0) > STUCK_SECONDS:
+                        raise asyncio.TimeoutError(f"No query has finished on the full pool in {STUCK_SECONDS} seconds")
+                    await asyncio.wait_for(self._ping_alone(key), PING_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self._ping(pool), PING_TIMEOUT)
+                    self.record_success(key)
+                self._health(key).set()
+                return
+            except Exception:
+                log.warning(f"Health check failed for {key.user}@{key.host}:{key.port}/{key.db}", exc_info=True)
+                self._health(key).clear()
+                address = self.addresses.get(key)
+                if address is not None:
+                    self.resolver.demote(key.host, address)
+
+        if key not in self._specs or time.monotonic() < self._next_attempt.get(key, 0):
+            return
+        try:
+            await self.replace(key)
+        except Exception as e:
+            if key not in self._specs:
+                # Discarded while we were connecting it
+                return
+            self._failures[key] += 1
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self._failures[key] - 1))
+            # Jitter, so bots sharing a database don't all come back at the same instant
+            delay = random.uniform(delay / 2, delay)
+            self._next_attempt[key] = time.monotonic() + delay
+            # Anything but an unreachable server (a mistyped host, a database that doesn't exist) gets its traceback logged
+            log.warning(f"Could not connect to {key.user}@{key.host}:{key.port}/{key.db}, retrying in {delay:.1f} seconds",
+                exc_info=not isinstance(e, CONNECTION_ERRORS))
+
+    async def _ping(self, pool):
+        async with pool.acquire() as conn:
+            await conn.ping(reconnect=False)
+
+    async def _ping_alone(self, key: PoolKey):
+        """
+        Ping the pool's server on a connection of its own, for when every pooled connection is busy
+        """
+        conn = await aiomysql.connect(host=self.addresses.get(key, key.host), port=key.port, db=key.db, user=key.user,
+            password=self._specs[key].password, connect_timeout=PING_TIMEOUT)
+        try:
+            await conn.ping(reconnect=False)
+        finally:
+            conn.close()
@@ -0,0 +1,231 @@
+"""
+Catalogue of the statements TGDB runs against the tg schema
+
+Every statement is built with SQLAlchemy Core from the tables in tgcommon.models.tgschema, renamed with the guild's table
+prefix, and compiled once to the MySQL dialect. A statement naming a table or column the schema doesn't have fails when
+the catalogue is validated at cog load rather than halfway through a command, and running a compiled statement is only
+binding its named parameters.
+
+Each statement carries the metadata the executor needs to run it (does it write, how many rows it produces)
+
+Batch statements are built for a fixed size IN (...) list of parameters k0..kN, see batch_size_for
+"""
+from collections import namedtuple
+
+from sqlalchemy import Column, MetaData, bindparam, false, func, literal_column, select, text, true, update
+from sqlalchemy.dialects import mysql
+from sqlalchemy.sql import visitors
+
+from tgcommon.models import DiscordLink, tgschema
+from tgcommon.schemadrift import COLUMNS_SQL, INDEXES_SQL
+from tgcommon.tablestats import ESTIMATES_SQL
+
+# Expected cardinality of a statement, decides how the executor fetches the result
+ONE = "one" # At most one row, returned as the row or None
+MANY = "many" # Any number of rows, returned as a list
+NONE = "none" # A write, the executor returns the number of affected rows
+
+# build(tables, size) returns the SQLAlchemy statement, tables are the prefixed tgschema tables keyed by unprefixed name
+# redact names the parameters that are secrets (one time tokens) and must never be logged
+# needs lists the (table, columns) each statement filters (and orders) on, for the index advisor
+# batch statements take an IN (...) list of size k0..kN parameters
+# positional statements return plain tuples in the order of their select list instead of dicts
+# primary reads must see the latest writes (tokens the game just inserted, links just cleared) so never go to a read replica
+# sql is the compiled statement and uses the (table, column) pairs it references, both filled in by the catalogue
+Statement = namedtuple('Statement', 'name, build, readonly, cardinality, redact, needs, batch, positional, primary, sql, uses',
+    defaults=((), (), False, False, False, None, frozenset()))
+
+# aiomysql takes %(name)s placeholders with a dict of parameters
+DIALECT = mysql.dialect(paramstyle="pyformat")
+
+# Largest IN (...) list a batch statement is built with, longer key lists are split into chunks of this size
+MAX_BATCH = 256
+
+# Tokens the game generates are only good for this long
+TOKEN_LIFETIME = literal_column("INTERVAL 4 HOUR")
+# LIMIT 1 written into the SQL, .limit(1) would add a bind parameter
+LIMIT_ONE = literal_column("1")
+
+def batch_size_for(count: int) -> int:
+    """
+    Round a chunk length up to a power of two, so any batch only ever produces a handful of distinct statements
+    """
+    size = 1
+    while size < count:
+        size *= 2
+    return min(size, MAX_BATCH)
+
+def batch_parameters(keys: list, size: int) -> dict:
+    """
+    Bind a chunk of keys to the k0..kN parameters of a batch statement, padding with the last key (repeats in IN are harmless)
+    """
+    padded = list(keys) + [keys[-1]] * (size - len(keys))
+    return {f"k{i}": key for i, key in enumerate(padded)}
+
+def batch_keys(size: int) -> list:
+    return [bindparam(f"k{i}") for i in range(size)]
+
+def discord_link_columns(links):
+    # Same order as the DiscordLink fields, so positional rows go straight into DiscordLink.from_rows
+    return [links.c[field] for field in DiscordLink._fields]
+
+def role_minutes(tables, job: str):
+    """
+    The player's minutes in one role_time job, 0 if they have never played it
+    """
+    player, role_time = tables["player"], tables["role_time"]
+    minutes = select(role_time.c.minutes).where(role_time.c.ckey == player.c.ckey, role_time.c.job == literal_column(f"'{job}'"))
+    return func.coalesce(minutes.scalar_subquery(), literal_column("0"))
+
+def select_players(tables):
+    player = tables["player"]
+    return select(player.c.ckey, player.c.firstseen, player.c.lastseen, player.c.computerid, player.c.ip, player.c.accountjoindate,
+        role_minutes(tables, "Living").label("living_time"), role_minutes(tables, "Ghost").label("ghost_time"))
+
+def build_lookup_ckey_by_token(tables, size):
+    links = tables["discord_links"]
+    return select(links.c.ckey).where(links.c.one_time_token == bindparam("one_time_token"),
+        links.c.timestamp >= func.now() - TOKEN_LIFETIME, links.c.discord_id.is_(None)).order_by(links.c.timestamp.desc()).limit(LIMIT_ONE)
+
+def build_discord_link_for_discord_id(tables, size):
+    links = tables["discord_links"]
+    return select(*discord_link_columns(links)).where(links.c.discord_id == bindparam("discord_id"),
+        links.c.ckey.isnot(None)).order_by(links.c.timestamp.desc()).limit(LIMIT_ONE)
+
+def build_discord_link_for_ckey(tables, size):
+    links = tables["discord_links"]
+    return select(*discord_link_columns(links)).where(links.c.ckey == bindparam("ckey"),
+        links.c.discord_id.isnot(None)).order_by(links.c.timestamp.desc()).limit(LIMIT_ONE)
+
+def build_all_discord_links_for_ckey(tables, size):
+    links = tables["discord_links"]
+    return select(*discord_link_columns(links)).where(links.c.ckey == bindparam("ckey"),
+        links.c.discord_id.isnot(None)).order_by(links.c.timestamp.desc())
+
+def build_update_discord_link(tables, size):
+    links = tables["discord_links"]
+    # Columns as keys rather than keywords, so they show up in the statement's uses
+    return update(links).values({links.c.discord_id: bindparam("discord_id"), links.c.valid: true()}).where(
+        links.c.one_time_token == bindparam("one_time_token"), links.c.timestamp >= func.now() - TOKEN_LIFETIME,
+        links.c.discord_id.is_(None))
+
+def build_clear_all_valid_discord_links_for_ckey(tables, size):
+    links = tables["discord_links"]
+    return update(links).values({links.c.valid: false()}).where(links.c.ckey == bindparam("ckey"), links.c.valid == true())
+
+def build_clear_all_valid_discord_links_for_discord_id(tables, size):
+    links = tables["discord_links"]
+    return update(links).values({links.c.valid: false()}).where(links.c.discord_id == bindparam("discord_id"), links.c.valid == true())
+
+def build_player_by_ckey(tables, size):
+    return select_players(tables).where(tables["player"].c.ckey == bindparam("ckey"))
+
+def build_discord_links_for_discord_ids(tables, size):
+    links = tables["discord_links"]
+    return select(*discord_link_columns(links)).where(links.c.discord_id.in_(batch_keys(size)),
+        links.c.ckey.isnot(None)).order_by(links.c.timestamp.desc())
+
+def build_discord_links_for_ckeys(tables, size):
+    links = tables["discord_links"]
+    return select(*discord_link_columns(links)).where(links.c.ckey.in_(batch_keys(size)),
+        links.c.discord_id.isnot(None)).order_by(links.c.timestamp.desc())
+
+def build_players_by_ckeys(tables, size):
+    return select_players(tables).where(tables["player"].c.ckey.in_(batch_keys(size)))
+
+def build_player_ckeys_seen_since(tables, size):
+    player = tables["player"]
+    return select(player.c.ckey, player.c.lastseen).where(player.c.lastseen >= bindparam("since"))
+
+# information_schema isn't part of tgschema, so these stay as text
+def build_index_columns(tables, size):
+    return text(INDEXES_SQL)
+
+def build_schema_columns(tables, size):
+    return text(COLUMNS_SQL)
+
+def build_table_estimates(tables, size):
+    return text(ESTIMATES_SQL)
+
+STATEMENTS = {statement.name: statement for statement in (
+    Statement("lookup_ckey_by_token", build_lookup_ckey_by_token,
+        True, ONE, ("one_time_token",), (("discord_links", ("one_time_token",)),), primary=True),
+    Statement("discord_link_for_discord_id", build_discord_link_for_discord_id,
+        True, ONE, (), (("discord_links", ("discord_id", "timestamp")),), positional=True, primary=True),
+    Statement("discord_link_for_ckey", build_discord_link_for_ckey,
+        True, ONE, (), (("discord_links", ("ckey", "timestamp")),), positional=True, primary=True),
+    Statement("all_discord_links_for_ckey", build_all_discord_links_for_ckey,
+        True, MANY, (), (("discord_links", ("ckey", "timestamp")),), positional=True),
+    Statement("update_discord_link", build_update_discord_link,
+        False, NONE, ("one_time_token",), (("discord_links", ("one_time_token",)),)),
+    Statement("clear_all_valid_discord_links_for_ckey", build_clear_all_valid_discord_links_for_ckey,
+        False, NONE, (), (("discord_links", ("ckey",)),)),
+    Statement("clear_all_valid_discord_links_for_discord_id", build_clear_all_valid_discord_links_for_discord_id,
+        False, NONE, (), (("discord_links", ("discord_id",)),)),
+    Statement("player_by_ckey", build_player_by_ckey,
+        True, ONE, (), (("player", ("ckey",)), ("role_time", ("ckey", "job")))),
+    Statement("discord_links_for_discord_ids", build_discord_links_for_discord_ids,
+        True, MANY, (), (("discord_links", ("discord_id",)),), batch=True, positional=True, primary=True),
+    Statement("discord_links_for_ckeys", build_discord_links_for_ckeys,
+        True, MANY, (), (("discord_links", ("ckey",)),), batch=True, positional=True, primary=True),
+    Statement("players_by_ckeys", build_players_by_ckeys,
+        True, MANY, (), (("player", ("ckey",)), ("role_time", ("ckey", "job"))), batch=True),
+    Statement("player_ckeys_seen_since", build_player_ckeys_seen_since,
+        True, MANY, (), (("player", ("lastseen",)),), positional=True),
+    Statement("index_columns", build_index_columns,
+        True, MANY),
+    Statement("table_estimates", build_table_estimates,
+        True, MANY),
+    Statement("schema_columns", build_schema_columns,
+        True, MANY),
+)}
+
+def prefixed_tables(prefix: str) -> dict:
+    """
+    The tgschema tables renamed with this prefix, keyed by their unprefixed name
+    """
+    if not prefix:
+        return dict(tgschema.metadata.tables)
+    metadata = MetaData()
+    return {name: table.to_metadata(metadata, name=f"{prefix}{name}") for name, table in tgschema.metadata.tables.items()}
+
+class QueryCatalogue:
+    """
+    Hands out statements compiled for a table prefix (and batch size), each combination is only compiled once
+    """
+    def __init__(self, statements: dict = STATEMENTS):
+        self.statements = statements
+        self._tables = {}
+        self._built = {}
+
+    def validate(self):
+        """
+        Compile every statement, so one that doesn't match tgschema fails when the cog loads
+        """
+        for name, template in self.statements.items():
+            self.get("", name, MAX_BATCH if template.batch else None)
+
+    def tables(self, prefix: str) -> dict:
+        tables = self._tables.get(prefix)
+        if tables is None:
+            tables = self._tables[prefix] = prefixed_tables(prefix)
+        return tables
+
+    def get(self, prefix: str, name: str, size: int = None) -> Statement:
+        statement = self._built.get((prefix, name, size))
+        if statement is None:
+            template = self.statements[name]
+            tables = self.tables(prefix)
+            construct = template.build(tables, size)
+            compiled = construct.compile(dialect=DIALECT)
+            # The executor only passes the caller's parameters, anything else has to be a literal in the SQL
+            constants = sorted(bind for bind, value in compiled.params.items() if value is not None)
+            if constants:
+                raise ValueError(f"Statement {name} binds constants {', '.join(constants)}, write them as literals")
+            # Unprefixed, so they can be checked against a schemadrift report
+            names = {table: table_name for table_name, table in tables.items()}
+            uses = frozenset((names[element.table], element.name) for element in visitors.iterate(construct)
+                if isinstance(element, Column) and element.table in names)
+            statement = template._replace(name=f"{name}[{size}]" if size else name, sql=compiled.string, uses=uses)
+            self._built[(prefix, name, size)] = statement
+        return statement
@@ -0,0 +1,73 @@
+#Standard Imports
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+
+log = logging.getLogger("red.oranges_tgdb")
+
+class Resolver:
+    """
+    Resolves database hosts through the event loop's resolver, so a slow DNS server never blocks the bot
+
+    Answers are cached for ttl seconds. Every address a host resolves to is kept, in the order to try them, and an
+    address that fails to connect is moved to the back so the next connect fails over to the others
+    """
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._cache = {}
+        # Resolution timing, shown by the owner commands
+        self.lookups = 0
+        self.cache_hits = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    async def resolve(self, host: str, port: int) -> list:
+        """
+        Return the addresses for host, best first
+        """
+        try:
+            # Literal addresses need no lookup
+            return [str(ipaddress.ip_address(host))]
+        except ValueError:
+            pass
+
+        entry = self._cache.get(host)
+        if entry is not None and entry[0] > time.monotonic():
+            self.cache_hits += 1
+            return list(entry[1])
+
+        start = time.perf_counter()
+        try:
+            infos = await asyncio.get_event_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.lookups += 1
+            self.total_seconds += elapsed
+            self.last_seconds = elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        log.debug(f"Resolved {host} to {addresses} in {elapsed * 1000:.1f}ms")
+        self._cache[host] = (time.monotonic() + self.ttl, addresses)
+        return list(addresses)
+
+    def demote(self, host: str, address: str):
+        """
+        Move an address that failed to connect to the back of the host's cached list
+        """
+        entry = self._cache.get(host)
+        if entry is not None and address in entry[1] and len(entry[1]) > 1:
+            addresses = [other for other in entry[1] if other != address] + [address]
+            self._cache[host] = (entry[0], addresses)
+
+    def forget(self, host: str):
+        self._cache.pop(host, None)
+
+    @property
+    def average_seconds(self):
+        if self.lookups:
+            return self.total_seconds / self.lookups
+        return 0.0
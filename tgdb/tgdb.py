@@ -1,10 +1,13 @@
 #Standard Imports
 import asyncio
 import aiomysql
-import socket
-import ipaddress
+import io
 import re
+import datetime
 import logging
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
 
 #Discord Imports
 import discord
@@ -14,7 +17,18 @@ from redbot.core import commands, checks, Config
 from redbot.core.utils.chat_formatting import pagify, box, humanize_list, warning
 from redbot.core.utils.menus import menu, DEFAULT_CONTROLS
 
-from tgcommon.models import DiscordLink
+from tgcommon.cache import MISSING, TTLCache
+from tgcommon.ckeyindex import CkeyIndex
+from tgcommon.errors import TGUnrecoverableError
+from tgcommon.models import DiscordLink, Player
+from tgcommon.schemadrift import MISSING_COLUMN, MISSING_INDEX, MISSING_TABLE, TYPE_MISMATCH, check
+from tgcommon.tablestats import count_sql, describe, from_estimates, to_json, with_exact_count
+from tgcommon.util import looks_like_token
+
+from .indexes import FULL_SCAN, PARTIAL, add_index_sql, assess, live_indexes, missing_indexes
+from .metrics import Metrics, SlowQueryLog
+from .pool import CONNECTION_ERRORS, PoolKey, PoolRegistry, lost_connection
+from .queries import ONE, MANY, NONE, MAX_BATCH, QueryCatalogue, batch_parameters, batch_size_for
 
 __version__ = "1.0.0"
 __author__ = "oranges"
@@ -23,6 +37,60 @@ log = logging.getLogger("red.oranges_tgdb")
 
 BaseCog = getattr(commands, "Cog", object)
 
+# How many chunks of a batch lookup may be querying the database at once
+BATCH_CONCURRENCY = 3
+# How long a query waits for its database to become healthy before giving up
+POOL_WAIT_SECONDS = 10
+# Seconds before a pool supervisor that died is started again
+SUPERVISOR_RESTART_DELAY = 5
+# Rows pulled from a server side cursor per network read when streaming
+STREAM_FETCH_SIZE = 500
+# Seconds before a ckey index is topped up with the players seen since it was last loaded
+CKEY_INDEX_REFRESH = 300
+# Earlier than any lastseen, the first load of a ckey index reads every player from here
+CKEY_INDEX_START = datetime.datetime(1970, 1, 1)
+# Tables scanned at once by an exact [p]tgdb tables, each scan holds a connection and churns the buffer pool
+TABLE_COUNT_CONCURRENCY = 2
+# Seconds before a database whose schema couldn't be checked is tried again from the query path
+SCHEMA_RETRY_SECONDS = 60
+# MySQL deadlock, the server picked this transaction to roll back and it can simply be run again. Lock wait timeouts (1205)
+# aren't retried, each one has already waited innodb_lock_wait_timeout (50 seconds by default)
+DEADLOCK_ERROR = 1213
+# Extra attempts a transaction gets after a deadlock, and seconds before the first (doubling after)
+DEADLOCK_RETRIES = 2
+DEADLOCK_DELAY = 0.1
+
+# Stands in for a command context in background work, the query paths only ever read ctx.guild
+GuildContext = namedtuple('GuildContext', 'guild')
+
+class Transaction:
+    """
+    Runs catalogue statements on one pooled connection, everything is committed together when the transaction block exits
+    """
+    def __init__(self, tgdb, conn, prefix: str, key, schema):
+        self.tgdb = tgdb
+        self.conn = conn
+        self.prefix = prefix
+        self.key = key
+        self.schema = schema
+        self.rollback_only = False
+
+    async def execute(self, name: str, parameters: dict):
+        statement = self.tgdb.queries.get(self.prefix, name)
+        self.tgdb.refuse_unusable(self.schema, statement)
+        self.tgdb.pool_registry.record_query(self.key)
+        try:
+            return await self.tgdb.run_statement(self.conn, statement, parameters, self.key)
+        except Exception as e:
+            self.tgdb.query_failed(self.key, e)
+            raise
+
+    def rollback(self):
+        """
+        Discard everything done in this transaction instead of committing it when the block exits
+        """
+        self.rollback_only = True
+
 class TGDB(BaseCog):
     """
     Connector that will integrate with any database using the latest tg schema, provides utility functionality
@@ -31,7 +99,8 @@ class TGDB(BaseCog):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=672261474290237490, force_registration=True)
         self.visible_config = ["mysql_host", "mysql_port", "mysql_user", "mysql_db", "mysql_prefix",
-        "min_living_minutes", "verified_role"]
+        "min_living_minutes", "verified_role", "mysql_pool_min", "mysql_pool_max",
+        "mysql_replica_host", "mysql_replica_port", "mysql_replica_user"]
 
         default_guild = {
             "mysql_host": "127.0.0.1",
@@ -42,10 +111,95 @@ class TGDB(BaseCog):
             "mysql_prefix": "",
             "min_living_minutes": 60,
             "verified_role": None,
+            "mysql_pool_min": 1,
+            "mysql_pool_max": 10,
+            # Optional read replica, read only statements go here, it uses the primary's database and password
+            "mysql_replica_host": "",
+            "mysql_replica_port": 3306,
+            "mysql_replica_user": "",
         }
 
         self.config.register_guild(**default_guild)
-        self.pool = None
+        # Statements slower than this (acquire + execute + fetch) are kept in the slow query log
+        self.config.register_global(slow_query_ms=250)
+        # Immutable per guild snapshot of the config above, query paths read this instead of awaiting Config
+        self.GuildSettings = namedtuple('GuildSettings', default_guild)
+        self.guild_settings_cache = {}
+        self.pool_registry = PoolRegistry()
+        self.pool_registry.on_connect = self.pool_connected
+        self.queries = QueryCatalogue()
+        # Compile every statement against tgschema now, a broken one stops the cog loading instead of failing a command
+        self.queries.validate()
+        self.metrics = Metrics()
+        self.slow_queries = SlowQueryLog()
+        # Latest DiscordLink (or None) per discord id and per ckey, keyed by (link_scope, key)
+        self.links_by_discord_id = TTLCache(maxsize=4096, ttl=120)
+        self.links_by_ckey = TTLCache(maxsize=4096, ttl=120)
+        # One time tokens that matched nothing, keyed by (link_scope, token), kept briefly so repeated attempts skip the database
+        self.failed_tokens = TTLCache(maxsize=4096, ttl=30)
+        self.malformed_tokens = 0
+        # link_scope -> CkeyIndex of that database's player table, and the lock its (re)loads hold
+        self.ckey_indexes = {}
+        self.ckey_index_locks = {}
+        # link_scope -> schemadrift.SchemaReport of that database, and the lock its checks hold
+        self.schema_reports = {}
+        # link_scope -> time.monotonic() a background check was last started from the query path
+        self.schema_attempts = {}
+        self.schema_locks = {}
+        # guild id -> PoolKey of the database (and read replica) that guild is currently using
+        self.guild_pool_keys = {}
+        self.guild_replica_keys = {}
+
+        self.start_supervisor_task()
+
+    def start_supervisor_task(self, delay: float = 0):
+        self.supervisor_task = self.bot.loop.create_task(self.start_supervisor(delay))
+        self.supervisor_task.add_done_callback(self.supervisor_done)
+
+    def supervisor_done(self, task):
+        """
+        Restart the supervisor if it died, without it no pool is ever connected or reconnected again
+        """
+        if task.cancelled():
+            return
+        error = task.exception()
+        log.error(f"The pool supervisor stopped, restarting it in {SUPERVISOR_RESTART_DELAY} seconds", exc_info=error)
+        self.start_supervisor_task(SUPERVISOR_RESTART_DELAY)
+
+    def cog_unload(self):
+        self.supervisor_task.cancel()
+        self.bot.loop.create_task(self.pool_registry.close_all())
+
+    async def load_guild_settings(self):
+        """
+        Warm the settings snapshots for every configured guild in one Config read
+        """
+        for guild_id, settings in (await self.config.all_guilds()).items():
+            # A guild read on demand while we were loading is at least as fresh as this
+            self.guild_settings_cache.setdefault(guild_id, self.GuildSettings(**{k: settings[k] for k in self.GuildSettings._fields}))
+
+    async def guild_settings(self, guild):
+        """
+        Return the settings snapshot for this guild, only touching Config if we have never seen the guild
+        """
+        settings = self.guild_settings_cache.get(guild.id)
+        if settings is None:
+            settings = await self.refresh_guild_settings(guild)
+        return settings
+
+    async def refresh_guild_settings(self, guild):
+        settings = await self.config.guild(guild).all()
+        snapshot = self.GuildSettings(**{k: settings[k] for k in self.GuildSettings._fields})
+        self.guild_settings_cache[guild.id] = snapshot
+        return snapshot
+
+    def update_guild_settings(self, guild, **changes):
+        """
+        Swap in a new snapshot with the given fields changed, called by the setters after they write to Config
+        """
+        settings = self.guild_settings_cache.get(guild.id)
+        if settings is not None:
+            self.guild_settings_cache[guild.id] = settings._replace(**changes)
 
     @commands.guild_only()
     @commands.group()
@@ -73,6 +227,199 @@ class TGDB(BaseCog):
         await self.reconnect_to_db_with_guild_context_config(ctx)
         await ctx.send(f"Database Connected")
 
+    @tgdb.command()
+    async def cache(self, ctx, reset: bool = False):
+        """
+        Show the hit rate of the discord link cache, pass true to empty it and reset the counters
+        """
+        if reset:
+            for cache in (self.links_by_discord_id, self.links_by_ckey, self.failed_tokens):
+                cache.clear()
+                cache.reset_stats()
+            self.malformed_tokens = 0
+            self.ckey_indexes.clear()
+            return await ctx.send("Discord link cache and ckey indexes emptied")
+
+        lines = []
+        for name, cache in (("discord id", self.links_by_discord_id), ("ckey", self.links_by_ckey)):
+            lines.append(f"by {name}: {len(cache)}/{cache.maxsize} entries, {cache.hits} hits, {cache.misses} misses, {cache.hit_ratio:.1%} hit rate")
+        lines.append(f"failed tokens: {len(self.failed_tokens)}/{self.failed_tokens.maxsize} entries, {self.failed_tokens.hits} repeats skipped,"
+            f" {self.malformed_tokens} malformed tokens rejected")
+        for (host, port, db, prefix), index in self.ckey_indexes.items():
+            lines.append(f"ckey index {host}:{port}/{db} {prefix}player: {len(index)} ckeys, seen up to {index.loaded_until}, "
+                f"refreshed {time.monotonic() - index.refreshed:.0f} seconds ago")
+        await ctx.send(box("\n".join(lines)))
+
+    @tgdb.command()
+    async def stats(self, ctx, reset: bool = False):
+        """
+        Show per statement latency percentiles (acquire/execute/fetch) and pool occupancy, pass true to start a new window
+        """
+        if reset:
+            self.metrics.reset()
+            return await ctx.send("Statement statistics reset")
+
+        window = time.time() - self.metrics.window_start
+        lines = [f"Window: {window / 60:.1f} minutes, times in ms as p50/p95/p99"]
+        for name, stats in sorted(self.metrics.statements.items()):
+            lines.append(f"{name}: {stats.execute.count} runs, {stats.errors} errors")
+            for phase, histogram in (("acquire", stats.acquire), ("execute", stats.execute), ("fetch", stats.fetch)):
+                p50, p95, p99 = (value * 1000 for value in histogram.percentiles(50, 95, 99))
+                lines.append(f"    {phase:<8} {p50:8.2f} {p95:8.2f} {p99:8.2f}")
+        lines.append("Pools (size/free/in use/peak in use):")
+        for key, pool in self.pool_registry.items():
+            lines.append(f"    {key.user}@{key.host}:{key.port}/{key.db} {pool.size}/{pool.freesize}/{pool.size - pool.freesize}"
+                f"/{self.metrics.peak_in_use.get(key, 0)}")
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @tgdb.command()
+    async def slowlog(self, ctx, clear: bool = False):
+        """
+        Dump the slow query log with the EXPLAIN of each slow statement, pass true to empty it
+        """
+        if clear:
+            self.slow_queries.clear()
+            return await ctx.send("Slow query log emptied")
+        if not self.slow_queries.entries:
+            return await ctx.send(f"No statements have taken longer than {self.slow_queries.threshold_ms}ms")
+
+        lines = []
+        for entry in reversed(self.slow_queries.entries):
+            when = datetime.datetime.utcfromtimestamp(entry.when).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"{when} {entry.name} acquire {entry.acquire * 1000:.1f}ms execute {entry.execute * 1000:.1f}ms"
+                f" fetch {entry.fetch * 1000:.1f}ms {entry.parameters}")
+        for name, explain in self.slow_queries.explains.items():
+            lines.append(f"EXPLAIN {name}:")
+            lines.append(explain or "    (pending)")
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @tgdb.command()
+    async def slow_threshold(self, ctx, milliseconds: int):
+        """
+        Sets how long a statement may take before it is recorded in the slow query log
+        """
+        if milliseconds < 1:
+            return await ctx.send(f"{milliseconds} is not a valid threshold!")
+        await self.config.slow_query_ms.set(milliseconds)
+        self.slow_queries.threshold_ms = milliseconds
+        await ctx.send(f"Slow query threshold set to: `{milliseconds}ms`")
+
+    @tgdb.command()
+    async def indexes(self, ctx, apply: bool = False):
+        """
+        Check the live schema has the indexes TGDB's queries need, pass true to add the missing ones from the tg schema
+
+        Adding indexes needs ALTER permission and locks the table while it builds on older MySQL versions
+        """
+        prefix = (await self.guild_settings(ctx.guild)).mysql_prefix
+        async with ctx.typing():
+            indexes = live_indexes(await self.execute(ctx, "index_columns", None), prefix)
+            assessments = assess(self.queries.statements, indexes)
+            missing = missing_indexes(self.queries.statements, indexes)
+
+            lines = []
+            for assessment in assessments:
+                if assessment.coverage == FULL_SCAN:
+                    lines.append(f"FULL SCAN {assessment.statement}: {assessment.table}({', '.join(assessment.columns)}) has no usable index")
+                elif assessment.coverage == PARTIAL:
+                    lines.append(f"partial   {assessment.statement}: {assessment.table}({', '.join(assessment.columns)}) only leads with"
+                        f" {assessment.index}")
+            if not lines:
+                lines.append("Every statement is covered by an index")
+            for index in missing:
+                lines.append(f"missing   {index.name} on {index.table}({', '.join(index.columns)})")
+
+            if apply:
+                for index in missing:
+                    try:
+                        await self.query_database(ctx, add_index_sql(prefix, index), None)
+                        lines.append(f"added     {index.name}")
+                    except aiomysql.Error as e:
+                        lines.append(f"FAILED    {index.name}: {e}")
+
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @tgdb.command()
+    async def tables(self, ctx, exact: bool = False):
+        """
+        Show the row count and size on disk of each tg schema table, pass true to count rows exactly instead of estimating
+
+        Exact counts scan every table and can take minutes on the big log tables
+        """
+        prefix = (await self.guild_settings(ctx.guild)).mysql_prefix
+        async with ctx.typing():
+            stats = from_estimates(await self.execute(ctx, "table_estimates", None), prefix)
+            if exact:
+                semaphore = asyncio.Semaphore(TABLE_COUNT_CONCURRENCY)
+
+                async def count(name):
+                    async with semaphore:
+                        rows = await self.query_database(ctx, count_sql(name, prefix), None)
+                        stats[name] = with_exact_count(stats[name], rows[0]["rows"])
+
+                await asyncio.gather(*(count(name) for name in list(stats)))
+
+        if not stats:
+            return await ctx.send(f"No tg schema tables found with the prefix {prefix}")
+        for page in pagify("\n".join(describe(stats))):
+            await ctx.send(box(page))
+        await ctx.send(file=discord.File(io.BytesIO(to_json(stats).encode()), filename="tables.json"))
+
+    @tgdb.command()
+    async def schema(self, ctx, refresh: bool = False):
+        """
+        Show how the database differs from the tg schema TGDB expects, pass true to check again now
+
+        Statements that need a missing table or column are refused until the database is migrated
+        """
+        async with ctx.typing():
+            report = await self.schema_report(ctx, refresh=refresh)
+
+        if not report:
+            return await ctx.send("The database matches the tg schema")
+        lines = []
+        for drift in report.by_kind(MISSING_TABLE):
+            lines.append(f"missing table   {drift.table}")
+        for drift in report.by_kind(MISSING_COLUMN):
+            lines.append(f"missing column  {drift.table}.{drift.name} {drift.expected or ''}")
+        for drift in report.by_kind(TYPE_MISMATCH):
+            lines.append(f"type mismatch   {drift.table}.{drift.name} is {drift.actual}, expected {drift.expected}")
+        for drift in report.by_kind(MISSING_INDEX):
+            lines.append(f"missing index   {drift.name} on {drift.table}({drift.expected})")
+        prefix = (await self.guild_settings(ctx.guild)).mysql_prefix
+        refused = [name for name, template in sorted(self.queries.statements.items())
+            if report.unusable(self.queries.get(prefix, name, 1 if template.batch else None).uses)]
+        if refused:
+            lines.append(f"Refusing to run: {humanize_list(refused)}")
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @tgdb.command()
+    async def pools(self, ctx):
+        """
+        List the open database pools and the guilds using them
+        """
+        lines = []
+        for key, pool in self.pool_registry.items():
+            guilds = [str(guild_id) for guild_id, guild_key in self.guild_pool_keys.items() if guild_key == key]
+            replica_guilds = [str(guild_id) for guild_id, guild_key in self.guild_replica_keys.items() if guild_key == key]
+            role = "replica" if replica_guilds else "primary"
+            if not self.pool_registry.is_healthy(key):
+                role += " (down)"
+            address = self.pool_registry.addresses.get(key, "?")
+            lines.append(f"{key.user}@{key.host}({address}):{key.port}/{key.db} {role} size {pool.size}/{pool.maxsize} free {pool.freesize}"
+                f" queries {self.pool_registry.query_counts[key]} guilds: {humanize_list(guilds + replica_guilds) if guilds or replica_guilds else 'none'}")
+        if not lines:
+            return await ctx.send("No database pools are open")
+        resolver = self.pool_registry.resolver
+        lines.append(f"DNS: {resolver.lookups} lookups, {resolver.cache_hits} cached, avg {resolver.average_seconds * 1000:.1f}ms,"
+            f" last {resolver.last_seconds * 1000:.1f}ms, max {resolver.max_seconds * 1000:.1f}ms")
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
     @tgdb_config.command()
     @checks.is_owner()
     async def host(self, ctx, db_host: str):
@@ -81,6 +428,7 @@ class TGDB(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_host.set(db_host)
+            self.update_guild_settings(ctx.guild, mysql_host=db_host)
             await ctx.send(f"Database host set to: `{db_host}`")
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was an error setting the database's ip/hostname. Please check your entry and try again!")
@@ -95,6 +443,7 @@ class TGDB(BaseCog):
         try:
             if 1024 <= db_port <= 65535: # We don't want to allow reserved ports to be set
                 await self.config.guild(ctx.guild).mysql_port.set(db_port)
+                self.update_guild_settings(ctx.guild, mysql_port=db_port)
                 await ctx.send(f"Database port set to: `{db_port}`")
             else:
                 await ctx.send(f"{db_port} is not a valid port!")
@@ -112,6 +461,7 @@ class TGDB(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_user.set(user)
+            self.update_guild_settings(ctx.guild, mysql_user=user)
             await ctx.send(f"User set to: `{user}`")
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem setting the username for your database.")
@@ -127,6 +477,7 @@ class TGDB(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_password.set(passwd)
+            self.update_guild_settings(ctx.guild, mysql_password=passwd)
             await ctx.send("Your password has been set.")
             try:
                 await ctx.message.delete()
@@ -144,6 +495,7 @@ class TGDB(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_db.set(db)
+            self.update_guild_settings(ctx.guild, mysql_db=db)
             await ctx.send(f"Database set to: `{db}`")
         except (ValueError, KeyError, AttributeError):
             await ctx.send ("There was a problem setting your notes database.")
@@ -160,15 +512,63 @@ class TGDB(BaseCog):
         try:
             if prefix is None:
                 await self.config.guild(ctx.guild).mysql_prefix.set("")
+                self.update_guild_settings(ctx.guild, mysql_prefix="")
                 await ctx.send(f"Database prefix removed!")
             else:
                 await self.config.guild(ctx.guild).mysql_prefix.set(prefix)
+                self.update_guild_settings(ctx.guild, mysql_prefix=prefix)
                 await ctx.send(f"Database prefix set to: `{prefix}`")
 
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem setting your database prefix")
 
 
+    @tgdb_config.command()
+    @checks.is_owner()
+    async def pool_size(self, ctx, minsize: int, maxsize: int):
+        """
+        Sets the minimum and maximum number of connections kept open to this guild's database
+
+        Takes effect on the next reconnect
+        """
+        try:
+            if 0 <= minsize <= maxsize and maxsize >= 1:
+                await self.config.guild(ctx.guild).mysql_pool_min.set(minsize)
+                await self.config.guild(ctx.guild).mysql_pool_max.set(maxsize)
+                self.update_guild_settings(ctx.guild, mysql_pool_min=minsize, mysql_pool_max=maxsize)
+                await ctx.send(f"Pool size set to: `{minsize}-{maxsize}`")
+            else:
+                await ctx.send(f"{minsize}-{maxsize} is not a valid pool size!")
+        except (ValueError, KeyError, AttributeError):
+            await ctx.send("There was a problem setting the pool size")
+
+
+    @tgdb_config.command()
+    @checks.is_owner()
+    async def replica(self, ctx, replica_host: str = None, replica_port: int = 3306, replica_user: str = None):
+        """
+        Sets a read replica that read only queries are sent to, it must serve the same database with the same password
+
+        Leave the host blank to stop using a replica, the user defaults to the primary's user
+        """
+        try:
+            if not 1024 <= replica_port <= 65535:
+                return await ctx.send(f"{replica_port} is not a valid port!")
+            await self.config.guild(ctx.guild).mysql_replica_host.set(replica_host or "")
+            await self.config.guild(ctx.guild).mysql_replica_port.set(replica_port)
+            await self.config.guild(ctx.guild).mysql_replica_user.set(replica_user or "")
+            self.update_guild_settings(ctx.guild, mysql_replica_host=replica_host or "", mysql_replica_port=replica_port,
+                mysql_replica_user=replica_user or "")
+            if ctx.guild.id in self.guild_pool_keys:
+                await self.register_guild(ctx.guild.id, await self.guild_settings(ctx.guild))
+            if replica_host:
+                await ctx.send(f"Read replica set to: `{replica_host}:{replica_port}`")
+            else:
+                await ctx.send(f"Read replica removed!")
+        except (ValueError, KeyError, AttributeError):
+            await ctx.send("There was a problem setting the read replica")
+
+
     @checks.mod_or_permissions(administrator=True)
     @tgdb_config.command()
     async def current(self, ctx):
@@ -189,171 +589,687 @@ class TGDB(BaseCog):
         await ctx.send(embed=embed)
 
 
-    async def update_discord_link(self, ctx, one_time_token: str, user_discord_snowflake: str):
+    def link_scope(self, settings):
+        """
+        Identifies the discord_links table a guild reads, guilds on the same table share cache entries
+        """
+        return (settings.mysql_host, settings.mysql_port, settings.mysql_db, settings.mysql_prefix)
+
+    async def update_discord_link(self, ctx, one_time_token: str, user_discord_snowflake: str, ckey: str = None):
         """
         Given a one time token, and a discord user snowflake, insert the snowflake for the matching record in the discord links table
+
+        Pass the ckey the token belongs to if it is known, so only that ckey's cached link is invalidated
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"UPDATE {prefix}discord_links SET discord_id = %s, valid = TRUE WHERE one_time_token = %s AND timestamp >= Now() - INTERVAL 4 HOUR AND discord_id IS NULL"
-        parameters = [user_discord_snowflake, one_time_token]
-        query = await self.query_database(ctx, query, parameters)
+        updated = await self.execute(ctx, "update_discord_link", {"one_time_token": one_time_token, "discord_id": user_discord_snowflake})
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        self.failed_tokens.pop((scope, one_time_token))
+        self.links_by_discord_id.pop((scope, int(user_discord_snowflake)))
+        if ckey is not None:
+            self.links_by_ckey.pop((scope, ckey.lower()))
+        else:
+            self.links_by_ckey.pop_where(lambda key, link: key[0] == scope)
+        return updated
 
     async def lookup_ckey_by_token(self, ctx, one_time_token: str):
         """
         Given a one time token, search the {prefix}discord_links table for that one time token and return the ckey it's connected to
         checks that the timestamp of the one time token has not exceeded 4 hours (hence expired) or there is no discord_id associated
         to that one time key already (it has been used), or it is has not been set to invalid
+
+        Tokens that can't be one, or that matched nothing in the last few seconds, return None without a query
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"SELECT ckey FROM {prefix}discord_links WHERE one_time_token = %s AND timestamp >= Now() - INTERVAL 4 HOUR AND discord_id IS NULL ORDER BY timestamp DESC LIMIT 1";
-        parameters = [one_time_token]
-        results = await self.query_database(ctx, query, parameters)
-        if len(results):
-            return results[0]["ckey"]
+        if not looks_like_token(one_time_token):
+            self.malformed_tokens += 1
+            return None
+        key = (self.link_scope(await self.guild_settings(ctx.guild)), one_time_token)
+        if self.failed_tokens.get(key) is not MISSING:
+            return None
+        result = await self.execute(ctx, "lookup_ckey_by_token", {"one_time_token": one_time_token})
+        if result:
+            return result["ckey"]
+        # lookup_ckey_by_token is marked primary in the catalogue, so this miss is final and not a replica lagging behind
+        self.failed_tokens.set(key, True)
 
     async def discord_link_for_discord_id(self, ctx, discord_id):
         """
         Given a valid discord id, return the latest record linked to that user
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"SELECT * FROM {prefix}discord_links WHERE discord_id = %s AND ckey IS NOT NULL ORDER BY timestamp DESC LIMIT 1";
-        parameters = [discord_id]
-        results = await self.query_database(ctx, query, parameters)
-        if len(results):
-            return DiscordLink.from_db_record(results[0])
-
-        return None
+        key = (self.link_scope(await self.guild_settings(ctx.guild)), int(discord_id))
+        link = self.links_by_discord_id.get(key)
+        if link is MISSING:
+            result = await self.execute(ctx, "discord_link_for_discord_id", {"discord_id": discord_id})
+            link = DiscordLink._make(result) if result else None
+            self.links_by_discord_id.set(key, link)
+        return link
 
     async def discord_link_for_ckey(self, ctx, ckey):
         """
         Given a valid ckey, return the latest record linked to that user
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"SELECT * FROM {prefix}discord_links WHERE ckey = %s AND discord_id IS NOT NULL ORDER BY timestamp DESC LIMIT 1";
-        parameters = [ckey]
-        results = await self.query_database(ctx, query, parameters)
-        if len(results):
-            return DiscordLink.from_db_record(results[0])
-
-        return None
+        key = (self.link_scope(await self.guild_settings(ctx.guild)), ckey.lower())
+        link = self.links_by_ckey.get(key)
+        if link is MISSING:
+            result = await self.execute(ctx, "discord_link_for_ckey", {"ckey": ckey})
+            link = DiscordLink._make(result) if result else None
+            self.links_by_ckey.set(key, link)
+        return link
 
     async def clear_all_valid_discord_links_for_ckey(self, ctx, ckey):
         """
         Set the valid field to false for all links for the given ckey
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"UPDATE {prefix}discord_links SET valid = FALSE WHERE ckey = %s AND valid = TRUE";
-        parameters = [ckey]
-        results = await self.query_database(ctx, query, parameters)
+        updated = await self.execute(ctx, "clear_all_valid_discord_links_for_ckey", {"ckey": ckey})
+        self.forget_links_for_ckey(self.link_scope(await self.guild_settings(ctx.guild)), ckey)
+        return updated
 
     async def clear_all_valid_discord_links_for_discord_id(self, ctx, discord_id):
         """
         Set the valid field to false for all links for the given discord id
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"UPDATE {prefix}discord_links SET valid = FALSE WHERE discord_id = %s AND valid = TRUE";
-        parameters = [discord_id]
-        results = await self.query_database(ctx, query, parameters)
+        updated = await self.execute(ctx, "clear_all_valid_discord_links_for_discord_id", {"discord_id": discord_id})
+        self.forget_links_for_discord_id(self.link_scope(await self.guild_settings(ctx.guild)), discord_id)
+        return updated
+
+    def forget_links_for_ckey(self, scope, ckey):
+        """
+        Drop every cached link that a change to this ckey's links could have made stale
+        """
+        self.links_by_ckey.pop((scope, ckey.lower()))
+        self.links_by_discord_id.pop_where(lambda key, link: key[0] == scope and link is not None and link.ckey.lower() == ckey.lower())
+
+    def forget_links_for_discord_id(self, scope, discord_id):
+        """
+        Drop every cached link that a change to this discord id's links could have made stale
+        """
+        self.links_by_discord_id.pop((scope, int(discord_id)))
+        self.links_by_ckey.pop_where(lambda key, link: key[0] == scope and link is not None and link.discord_id == int(discord_id))
+
+    async def complete_verification(self, ctx, ckey: str, one_time_token: str, discord_id) -> bool:
+        """
+        Swap the user's valid link over to this one time token in a single transaction, invalidating any previous links for
+        the ckey or the discord id
+
+        Returns False (and changes nothing) if the token no longer matches an unused, unexpired link
+
+        Without indexes on discord_links each update scans the table holding row locks until the commit, so a deadlock
+        against another verify (or the game servers) is retried a couple of times
+        """
+        for attempt in range(DEADLOCK_RETRIES + 1):
+            try:
+                async with self.transaction(ctx) as tx:
+                    await tx.execute("clear_all_valid_discord_links_for_ckey", {"ckey": ckey})
+                    await tx.execute("clear_all_valid_discord_links_for_discord_id", {"discord_id": discord_id})
+                    matched = await tx.execute("update_discord_link", {"one_time_token": one_time_token, "discord_id": discord_id})
+                    if not matched:
+                        tx.rollback()
+                        return False
+                break
+            except aiomysql.OperationalError as e:
+                if not e.args or e.args[0] != DEADLOCK_ERROR or attempt == DEADLOCK_RETRIES:
+                    raise
+                log.warning(f"Verification of {ckey} was picked as a deadlock victim, retrying")
+                await asyncio.sleep(DEADLOCK_DELAY * 2 ** attempt)
+
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        self.failed_tokens.pop((scope, one_time_token))
+        self.forget_links_for_ckey(scope, ckey)
+        self.forget_links_for_discord_id(scope, discord_id)
+        return True
 
     async def all_discord_links_for_ckey(self, ctx, ckey):
         """
         Given a valid ckey, return a list of all the valid records in the discord_links table for this user as discord link records
         ordered by timestamp descending
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"SELECT * FROM {prefix}discord_links WHERE ckey = %s AND discord_id IS NOT NULL ORDER BY TIMESTAMP desc";
-        parameters = [ckey]
-        discord_links = list()
-        results = await self.query_database(ctx, query, parameters)
-        for result in results:
-            discord_links.append(DiscordLink.from_db_record(result))
-        return discord_links
+        results = await self.execute(ctx, "all_discord_links_for_ckey", {"ckey": ckey})
+        return DiscordLink.from_rows(results)
+
+    async def iter_discord_links_for_ckey(self, ctx, ckey, batch_size: int = 50):
+        """
+        Streaming version of all_discord_links_for_ckey, yields lists of up to batch_size DiscordLinks, newest first
+        """
+        rows_stream = self.stream_query(ctx, "all_discord_links_for_ckey", {"ckey": ckey}, batch_size=batch_size)
+        try:
+            async for rows in rows_stream:
+                yield DiscordLink.from_rows(rows)
+        finally:
+            await rows_stream.aclose()
+
+    async def ckey_index(self, ctx):
+        """
+        The CkeyIndex of every ckey in the guild's player table, for prefix search and "did you mean" suggestions, None
+        until it has first been loaded
+
+        Loading never happens in the caller: the supervisor loads it when the database connects, and a stale one is topped
+        up with the players seen since in the background every CKEY_INDEX_REFRESH seconds
+        """
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        index = self.ckey_indexes.get(scope)
+        if index is None or time.monotonic() - index.refreshed >= CKEY_INDEX_REFRESH:
+            if not self.ckey_index_locks.setdefault(scope, asyncio.Lock()).locked():
+                self.bot.loop.create_task(self.refresh_ckey_index(ctx))
+        return index
+
+    async def refresh_ckey_index(self, ctx):
+        """
+        Load the guild's ckey index, or top it up if it is stale, sorting in a worker thread so the event loop keeps going
+        """
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        async with self.ckey_index_locks.setdefault(scope, asyncio.Lock()):
+            index = self.ckey_indexes.get(scope)
+            if index is not None and time.monotonic() - index.refreshed < CKEY_INDEX_REFRESH:
+                # Someone else refreshed it while we waited
+                return
+            if index is None:
+                index = CkeyIndex()
+            # Rows are collected first so the index is sorted once, and a half loaded index is never handed out
+            rows = []
+            since = index.loaded_until or CKEY_INDEX_START
+            try:
+                rows_stream = self.stream_query(ctx, "player_ckeys_seen_since", {"since": since}, batch_size=STREAM_FETCH_SIZE)
+                try:
+                    async for batch in rows_stream:
+                        rows.extend(batch)
+                finally:
+                    await rows_stream.aclose()
+                added = await self.bot.loop.run_in_executor(None, index.add, rows)
+            except Exception:
+                log.exception(f"Could not load the ckey index for {scope}")
+                return
+            log.debug(f"Ckey index for {scope} refreshed from {since}, {added} new ckeys")
+            self.ckey_indexes[scope] = index
+
+    async def suggest_ckeys(self, ctx, ckey: str, limit: int = 5) -> list:
+        """
+        Known ckeys close to one that matched nothing, for "did you mean", empty while the index is still loading
+
+        The edit distance search is CPU bound (about a second over a million ckeys), so it runs in a worker thread
+        """
+        index = await self.ckey_index(ctx)
+        if index is None or ckey in index:
+            return []
+        suggestions = await self.bot.loop.run_in_executor(None, index.similar, ckey, 2, limit)
+        return suggestions or index.starting_with(ckey, limit=limit)
+
+    def pool_connected(self, key):
+        self.bot.loop.create_task(self.warm(key))
+
+    async def warm(self, key):
+        """
+        Check the schema of, and load the ckey index for, a freshly (re)connected database, so no command has to wait for them
+        """
+        await self.bot.wait_until_ready()
+        scopes = set()
+        for guild_id, guild_key in list(self.guild_pool_keys.items()):
+            guild = self.bot.get_guild(guild_id)
+            settings = self.guild_settings_cache.get(guild_id)
+            if guild_key != key or guild is None or settings is None or self.link_scope(settings) in scopes:
+                continue
+            scopes.add(self.link_scope(settings))
+            # Checked again on every connect, the database may have been migrated while we were away from it
+            await self.check_schema(GuildContext(guild), refresh=True)
+            await self.refresh_ckey_index(GuildContext(guild))
 
     async def get_player_by_ckey(self, ctx, ckey: str):
         """
         Given a ckey, look up the player and return some useful information we use to calculate if we can verify this user or not, (do they have
         an appropriate amount of living time)
+
+        Player and role time come back in one round trip, returns a Player or None if the ckey has never connected
         """
-        prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        query = f"SELECT ckey, firstseen, lastseen, computerid, ip, accountjoindate FROM {prefix}player WHERE ckey=%s"
-        query = await self.query_database(ctx, query, [ckey])
-        results = {}
-        try:
-            query = query[0] # Checks to see if a player was found, if the list is empty nothing was found so we return the empty dict.
-        except IndexError:
+        result = await self.execute(ctx, "player_by_ckey", {"ckey": ckey})
+        if result:
+            return Player.from_db_record(result)
+
+        return None
+
+    async def discord_links_for_discord_ids(self, ctx, discord_ids):
+        """
+        Batch version of discord_link_for_discord_id, returns a dict of each given discord id to its latest link or None
+        """
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        links = {}
+        missing = []
+        for discord_id in discord_ids:
+            link = self.links_by_discord_id.get((scope, int(discord_id)))
+            if link is MISSING:
+                missing.append(int(discord_id))
+            else:
+                links[discord_id] = link
+
+        if missing:
+            found = {}
+            # Newest first, so the first row seen for an id is its latest link
+            for link in DiscordLink.from_rows(await self.execute_batched(ctx, "discord_links_for_discord_ids", missing)):
+                found.setdefault(link.discord_id, link)
+            for discord_id in missing:
+                self.links_by_discord_id.set((scope, discord_id), found.get(discord_id))
+            for discord_id in discord_ids:
+                if discord_id not in links:
+                    links[discord_id] = found.get(int(discord_id))
+        return links
+
+    async def discord_links_for_ckeys(self, ctx, ckeys):
+        """
+        Batch version of discord_link_for_ckey, returns a dict of each given ckey to its latest link or None
+        """
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        links = {}
+        missing = []
+        for ckey in ckeys:
+            link = self.links_by_ckey.get((scope, ckey.lower()))
+            if link is MISSING:
+                missing.append(ckey.lower())
+            else:
+                links[ckey] = link
+
+        if missing:
+            found = {}
+            for link in DiscordLink.from_rows(await self.execute_batched(ctx, "discord_links_for_ckeys", missing)):
+                found.setdefault(link.ckey.lower(), link)
+            for ckey in missing:
+                self.links_by_ckey.set((scope, ckey), found.get(ckey))
+            for ckey in ckeys:
+                if ckey not in links:
+                    links[ckey] = found.get(ckey.lower())
+        return links
+
+    async def players_by_ckeys(self, ctx, ckeys):
+        """
+        Batch version of get_player_by_ckey, returns a dict of each given ckey to its Player (with role time) or None
+        """
+        found = {}
+        for row in await self.execute_batched(ctx, "players_by_ckeys", [ckey.lower() for ckey in ckeys]):
+            found[row["ckey"].lower()] = Player.from_db_record(row)
+        return {ckey: found.get(ckey.lower()) for ckey in ckeys}
+
+    async def pool_for_guild(self, guild):
+        """
+        Return the pool this guild's queries run on, waiting a bounded time for the supervisor to make it healthy
+        """
+        key = self.guild_pool_keys.get(guild.id)
+        if key is None:
+            key = await self.register_guild(guild.id, await self.guild_settings(guild))
+
+        pool = await self.pool_registry.wait_for_pool(key, POOL_WAIT_SECONDS)
+        if pool is None:
+            raise TGUnrecoverableError("The database is not reachable at the moment, try again shortly")
+        return pool
+
+    async def register_guild(self, guild_id, settings):
+        """
+        Resolve a guild's settings to the keys of its database and read replica and hand them to the supervisor to connect
+
+        Returns the key of the primary
+        """
+        key = PoolKey(settings.mysql_host.lower(), settings.mysql_port, settings.mysql_db, settings.mysql_user)
+        self.pool_registry.register(key, settings.mysql_password, settings.mysql_pool_min, settings.mysql_pool_max)
+        old_key = self.guild_pool_keys.get(guild_id)
+        self.guild_pool_keys[guild_id] = key
+
+        replica_key = None
+        if settings.mysql_replica_host:
+            replica_key = PoolKey(settings.mysql_replica_host.lower(), settings.mysql_replica_port, settings.mysql_db,
+                settings.mysql_replica_user or settings.mysql_user)
+            self.pool_registry.register(replica_key, settings.mysql_password, settings.mysql_pool_min, settings.mysql_pool_max)
+        old_replica_key = self.guild_replica_keys.pop(guild_id, None)
+        if replica_key is not None:
+            self.guild_replica_keys[guild_id] = replica_key
+
+        for stale_key in (old_key, old_replica_key):
+            await self.release_if_unused(stale_key)
+        return key
+
+    async def release_if_unused(self, key):
+        """
+        Close the pool for this key if no guild uses it as a database or read replica any more
+        """
+        if key is not None and key not in self.guild_pool_keys.values() and key not in self.guild_replica_keys.values():
+            await self.pool_registry.discard(key)
+
+    async def replica_pool_for_guild(self, guild):
+        """
+        Return (key, pool) for the guild's read replica, or None if it has no replica or the replica is not healthy
+        """
+        settings = await self.guild_settings(guild)
+        if not settings.mysql_replica_host:
             return None
 
-        results['ip'] = ipaddress.IPv4Address(query['ip']) #IP's are stored as a 32 bit integer, converting it for readability
-        results['cid'] = query['computerid']
-        results['ckey'] = query['ckey']
-        results['first'] = query['firstseen']
-        results['last'] = query['lastseen']
-        results['join'] = query['accountjoindate']
+        if guild.id not in self.guild_pool_keys:
+            await self.pool_for_guild(guild)
+        key = self.guild_replica_keys.get(guild.id)
+        if key is None or not self.pool_registry.is_healthy(key):
+            return None
+        return key, self.pool_registry.get(key)
 
-        #Obtain role time statistics
-        query = f"SELECT job, minutes FROM {prefix}role_time WHERE ckey=%s AND (job='Ghost' OR job='Living')"
+    async def start_supervisor(self, delay: float = 0):
+        """
+        Load settings, register every configured guild's database so the pools are warm before anyone needs them,
+        then keep them healthy for as long as the cog is loaded
+        """
+        await asyncio.sleep(delay)
+        await self.load_guild_settings()
+        self.slow_queries.threshold_ms = await self.config.slow_query_ms()
+        for guild_id, settings in list(self.guild_settings_cache.items()):
+            await self.register_guild(guild_id, settings)
+        await self.pool_registry.supervise()
+
+    async def reconnect_to_db_with_guild_context_config(self, ctx):
+        """
+        Rebuild the pool for the database this guild uses, guilds on other databases are untouched
+        """
+        settings = await self.guild_settings(ctx.guild)
+        key = await self.register_guild(ctx.guild.id, settings)
+        # The database may have been migrated since it was last checked
+        self.schema_reports.pop(self.link_scope(settings), None)
+        # Pick up DNS changes too
+        self.pool_registry.resolver.forget(key.host)
+        await self.pool_registry.replace(key)
+        replica_key = self.guild_replica_keys.get(ctx.guild.id)
+        if replica_key is not None:
+            # Let the supervisor check the replica rather than making the owner wait on it
+            self.pool_registry.mark_unhealthy(replica_key)
+
+    async def schema_report(self, ctx, refresh: bool = False):
+        '''
+        How the guild's database differs from the tg schema, checked when its pool connects (see warm), or now if asked to
+        refresh or it hasn't been checked yet
+        '''
+        settings = await self.guild_settings(ctx.guild)
+        scope = self.link_scope(settings)
+        report = self.schema_reports.get(scope)
+        if not refresh and report is not None:
+            return report
+
+        async with self.schema_locks.setdefault(scope, asyncio.Lock()):
+            report = self.schema_reports.get(scope)
+            if not refresh and report is not None:
+                return report
+            columns, indexes = await asyncio.gather(self.execute(ctx, "schema_columns", None), self.execute(ctx, "index_columns", None))
+            report = check(columns, indexes, settings.mysql_prefix)
+            if report:
+                log.warning(f"Database {settings.mysql_db} on {settings.mysql_host} differs from the tg schema in {len(report.drifts)} places,"
+                    " see [p]tgdb schema")
+            self.schema_reports[scope] = report
+        return report
+
+    async def cached_schema_report(self, ctx):
+        '''
+        The guild's last schema report without checking, None if its database hasn't been checked yet
+        '''
+        scope = self.link_scope(await self.guild_settings(ctx.guild))
+        report = self.schema_reports.get(scope)
+        if report is None and time.monotonic() - self.schema_attempts.get(scope, -SCHEMA_RETRY_SECONDS) >= SCHEMA_RETRY_SECONDS:
+            # Configured after its database connected, or the check on connect failed, check it without holding anyone up
+            self.schema_attempts[scope] = time.monotonic()
+            self.bot.loop.create_task(self.check_schema(ctx))
+        return report
+
+    async def check_schema(self, ctx, refresh: bool = False):
         try:
-            query = await self.query_database(ctx, query, [ckey])
-        except aiomysql.Error:
-            query = None
-        if query:
-            for job in query:
-                if job['job'] == "Living":
-                    results['living_time'] = job['minutes']
-                else:
-                    results['ghost_time'] = job['minutes']
+            await self.schema_report(ctx, refresh=refresh)
+        except Exception:
+            log.exception(f"Could not check the schema for guild {ctx.guild.id}, statements run unchecked until it can be")
 
-            if 'living_time' not in results.keys():
-                results['living_time'] = 0
-            if 'ghost_time' not in results.keys():
-                results['ghost_time'] = 0
+    def refuse_unusable(self, report, statement):
+        '''
+        Raise before touching the database if the statement needs tables or columns the database doesn't have
 
-        else:
-            results['living_time'] = 0
-            results['ghost_time'] = 0
+        Without a report (the check is still running, or failed) the statement is let through, as it was before the check
+        '''
+        if report is None:
+            return
+        unusable = report.unusable(statement.uses)
+        if unusable:
+            raise TGUnrecoverableError(f"The database is missing {humanize_list([f'{table}.{column}' for table, column in unusable])}, "
+                f"which {statement.name} needs. It has to be migrated to the latest tg schema")
 
-            results['total_time'] = results['living_time'] + results['ghost_time']
+    async def execute(self, ctx, name: str, parameters: dict, size: int = None):
+        '''
+        Run a named statement from the query catalogue, specialised for the guild's table prefix (and IN list size for batches)
 
-        return results
+        Read only statements go to the guild's read replica if it has a healthy one, and fall back to the primary if it fails.
+        Reads marked primary in the catalogue always go to the primary, a lagging replica would hand them stale links
+        '''
+        statement = self.queries.get((await self.guild_settings(ctx.guild)).mysql_prefix, name, size)
+        if statement.uses:
+            self.refuse_unusable(await self.cached_schema_report(ctx), statement)
+        log.debug(f"Executing statement {name}, with parameters {parameters}")
+        if statement.readonly and not statement.primary:
+            replica = await self.replica_pool_for_guild(ctx.guild)
+            if replica is not None:
+                key, pool = replica
+                try:
+                    return await self.execute_on_pool(key, pool, statement, parameters)
+                except CONNECTION_ERRORS + (TGUnrecoverableError,):
+                    log.warning(f"Read replica {key.host}:{key.port} failed, reading from the primary until it recovers", exc_info=True)
+                    self.pool_registry.mark_unhealthy(key)
 
-    async def reconnect_to_db_with_guild_context_config(self, ctx):
-        db = await self.config.guild(ctx.guild).mysql_db()
-        db_host = socket.gethostbyname(await self.config.guild(ctx.guild).mysql_host())
-        db_port = await self.config.guild(ctx.guild).mysql_port()
-        db_user = await self.config.guild(ctx.guild).mysql_user()
-        db_pass = await self.config.guild(ctx.guild).mysql_password()
-        await self.reconnect_to_db(db, db_host, db_port, db_user, db_pass)
-
-    async def reconnect_to_db(self, db, db_host, db_port, db_user, db_pass):
+        pool = await self.pool_for_guild(ctx.guild)
+        return await self.execute_on_pool(self.guild_pool_keys[ctx.guild.id], pool, statement, parameters)
+
+    async def execute_on_pool(self, key, pool, statement, parameters: dict):
+        self.pool_registry.record_query(key)
+        stats = self.metrics.statement(statement.name)
+        start = time.perf_counter()
+        try:
+            conn = await self.acquire(pool)
+        except Exception:
+            stats.errors += 1
+            raise
+        acquired = time.perf_counter() - start
+        stats.acquire.record(acquired)
+        self.metrics.observe_pool(key, pool)
+        try:
+            result = await self.run_statement(conn, statement, parameters, key, acquired)
+        except Exception as e:
+            self.query_failed(key, e)
+            raise
+        finally:
+            pool.release(conn)
+        self.pool_registry.record_success(key)
+        return result
+
+    async def acquire(self, pool):
         '''
-        Open a connection to the database and save the pool in use
+        Take a connection from a pool, waiting at most POOL_WAIT_SECONDS, aiomysql has no read timeout so the connections
+        of a hung server never come back and an unbounded wait would hang every caller with them
         '''
-        # Database options loaded from the config
-        if self.pool:
-            self.pool.close()
-            await self.pool.wait_closed()
+        try:
+            return await asyncio.wait_for(pool.acquire(), POOL_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise TGUnrecoverableError("The database is too busy to answer at the moment, try again shortly") from None
 
-        # Establish a connection with the database and pull the relevant data, recycle them every 300 seconds
-        self.pool = await aiomysql.create_pool(host=db_host,port=db_port,db=db,user=db_user,password=db_pass, connect_timeout=5, pool_recycle=300)
+    def query_failed(self, key, error):
+        '''
+        Take a pool out of use until the supervisor sees it answer again, if the error says its server was lost
+        '''
+        if lost_connection(error):
+            log.warning(f"Lost the connection to {key.host}:{key.port}/{key.db}, waiting for it to recover")
+            self.pool_registry.mark_unhealthy(key)
 
-    async def query_database(self, ctx, query: str, parameters: list):
+    async def stream_query(self, ctx, name: str, parameters: dict, batch_size: int = None):
         '''
-        Use our active pool to pass in the given query
+        Async generator over the rows of a read only catalogue statement, read through an unbuffered server side cursor
+        so the full result is never held in memory
+
+        Yields single rows, or lists of up to batch_size rows if it is given. If the consumer stops early (break, cancellation)
+        the connection is closed rather than drained and handed back to the pool straight away
         '''
-        if not self.pool:
-            await self.reconnect_to_db_with_guild_context_config(ctx)
-            raise TGUnrecoverableError("The database was not connected,  a reconnect was attempted")
+        statement = self.queries.get((await self.guild_settings(ctx.guild)).mysql_prefix, name)
+        if not statement.readonly:
+            raise ValueError(f"{name} writes to the database and can't be streamed")
+        self.refuse_unusable(await self.cached_schema_report(ctx), statement)
+
+        replica = None if statement.primary else await self.replica_pool_for_guild(ctx.guild)
+        if replica is not None:
+            key, pool = replica
+        else:
+            pool = await self.pool_for_guild(ctx.guild)
+            key = self.guild_pool_keys[ctx.guild.id]
+        self.pool_registry.record_query(key)
 
+        log.debug(f"Streaming statement {name}, with parameters {parameters}")
+        stats = self.metrics.statement(f"{name}[stream]")
+        start = time.perf_counter()
+        conn = await self.acquire(pool)
+        stats.acquire.record(time.perf_counter() - start)
+        self.metrics.observe_pool(key, pool)
+        finished = False
         try:
-            log.debug(f"Executing query {query}, with parameters {parameters}")
-            async with self.pool.acquire() as conn:
-                async with conn.cursor(aiomysql.DictCursor) as cur:
-                    await cur.execute(query, parameters)
-                    rows = cur.fetchall()
-                    # WRITE TO STORAGE LOL
-                    await conn.commit()
-                    return rows.result()
+            cur = await conn.cursor(aiomysql.SSCursor if statement.positional else aiomysql.SSDictCursor)
+            start = time.perf_counter()
+            await cur.execute(statement.sql, parameters)
+            stats.execute.record(time.perf_counter() - start)
+            # Fetch time only counts reading from the server, not the time the consumer spends between batches
+            fetching = 0.0
+            while True:
+                start = time.perf_counter()
+                rows = await cur.fetchmany(batch_size or STREAM_FETCH_SIZE)
+                fetching += time.perf_counter() - start
+                if not rows:
+                    break
+                if batch_size:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+            await cur.close()
+            stats.fetch.record(fetching)
+            finished = True
+            self.pool_registry.record_success(key)
+        except Exception as e:
+            stats.errors += 1
+            self.query_failed(key, e)
+            raise
+        finally:
+            if not finished:
+                # Draining the rest of an unbuffered result could take as long as reading it, drop the connection instead
+                conn.close()
+            pool.release(conn)
 
-        except:
+    @asynccontextmanager
+    async def transaction(self, ctx):
+        '''
+        async with tgdb.transaction(ctx) as tx: run statements with tx.execute on one connection and commit them once
+
+        An exception (or tx.rollback()) inside the block rolls everything back instead
+        '''
+        prefix = (await self.guild_settings(ctx.guild)).mysql_prefix
+        schema = await self.cached_schema_report(ctx)
+        pool = await self.pool_for_guild(ctx.guild)
+        key = self.guild_pool_keys[ctx.guild.id]
+        start = time.perf_counter()
+        conn = await self.acquire(pool)
+        try:
+            self.metrics.statement("transaction").acquire.record(time.perf_counter() - start)
+            self.metrics.observe_pool(key, pool)
+            await conn.begin()
+            tx = Transaction(self, conn, prefix, key, schema)
+            try:
+                yield tx
+            except BaseException:
+                await conn.rollback()
+                raise
+            if tx.rollback_only:
+                await conn.rollback()
+            else:
+                await conn.commit()
+            self.pool_registry.record_success(key)
+        finally:
+            pool.release(conn)
+
+    async def execute_batched(self, ctx, name: str, keys: list):
+        '''
+        Run a batch statement over any number of keys, in chunks of at most MAX_BATCH with a bounded number in flight
+
+        Returns the rows of every chunk concatenated
+        '''
+        keys = list(dict.fromkeys(keys))
+        chunks = [keys[i:i + MAX_BATCH] for i in range(0, len(keys), MAX_BATCH)]
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def run_chunk(chunk):
+            async with semaphore:
+                size = batch_size_for(len(chunk))
+                return await self.execute(ctx, name, batch_parameters(chunk, size), size)
+
+        rows = []
+        for chunk_rows in await asyncio.gather(*(run_chunk(chunk) for chunk in chunks)):
+            rows.extend(chunk_rows)
+        return rows
+
+    async def run_statement(self, conn, statement, parameters: dict, key, acquired: float = 0.0):
+        '''
+        Execute a catalogue statement on the given connection and fetch according to its cardinality
+
+        Pools run in autocommit mode, so single reads never pay for a commit and single writes are committed by the server
+
+        Execute and fetch times are recorded against the statement's name, for buffered cursors the rows are read off the
+        network during execute, so fetch is only the cost of handing them back
+        '''
+        stats = self.metrics.statement(statement.name)
+        # Writes only need the rowcount, and positional statements skip building a dict per row
+        cursor_class = aiomysql.Cursor if statement.cardinality == NONE or statement.positional else aiomysql.DictCursor
+        try:
+            async with conn.cursor(cursor_class) as cur:
+                start = time.perf_counter()
+                await cur.execute(statement.sql, parameters)
+                executed = time.perf_counter()
+                stats.execute.record(executed - start)
+                if statement.cardinality == ONE:
+                    result = await cur.fetchone()
+                elif statement.cardinality == MANY:
+                    result = await cur.fetchall()
+                else:
+                    result = cur.rowcount
+                fetched = time.perf_counter()
+                stats.fetch.record(fetched - executed)
+        except Exception:
+            stats.errors += 1
             raise
 
+        if self.slow_queries.is_slow(acquired + fetched - start):
+            self.slow_queries.record(statement, parameters, acquired, executed - start, fetched - executed)
+            if self.slow_queries.needs_explain(statement.name):
+                self.bot.loop.create_task(self.capture_explain(key, statement, parameters))
+        return result
+
+    async def capture_explain(self, key, statement, parameters: dict):
+        '''
+        Run EXPLAIN for a slow statement on a connection of its own and keep the plan in the slow query log
+        '''
+        pool = self.pool_registry.get(key)
+        if pool is None:
+            self.slow_queries.explains.pop(statement.name, None)
+            return
+        try:
+            conn = await self.acquire(pool)
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute(f"EXPLAIN {statement.sql}", parameters)
+                    plan = await cur.fetchall()
+            finally:
+                pool.release(conn)
+        except (aiomysql.Error, TGUnrecoverableError):
+            log.warning(f"Could not EXPLAIN slow statement {statement.name}", exc_info=True)
+            self.slow_queries.explains.pop(statement.name, None)
+            return
+        self.slow_queries.explains[statement.name] = "\n".join(
+            f"    {row.get('table')} type={row.get('type')} key={row.get('key')} rows={row.get('rows')} extra={row.get('Extra')}"
+            for row in plan)
+
+    async def query_database(self, ctx, query: str, parameters: list):
+        '''
+        Use the guild's pool to pass in the given ad hoc query, prefer adding a statement to the catalogue and using execute
+        '''
+        pool = await self.pool_for_guild(ctx.guild)
+        log.debug(f"Executing query {query}, with parameters {parameters}")
+        conn = await self.acquire(pool)
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(query, parameters)
+                return await cur.fetchall()
+        finally:
+            pool.release(conn)
@@ -0,0 +1,120 @@
+"""
+Per guild admission queue for verify, so a burst of users waits its turn instead of being turned away
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+class QueueFull(Exception):
+    """
+    Raised when a user would join a queue that already holds max_queue users
+    """
+
+class QueueTimeout(Exception):
+    """
+    Raised when a queued user is not admitted within max_wait seconds
+    """
+
+class AdmissionQueue:
+    """
+    Lets up to workers verifications run at once, the rest wait in a bounded FIFO for at most max_wait seconds
+
+    A finishing verification hands its slot straight to the longest waiter, so nobody can jump the queue
+    """
+    def __init__(self, workers: int = 3, max_queue: int = 50, max_wait: float = 120):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = deque()
+        # Recent waits and verification times in seconds, for the ETA and [p]tgverify config current
+        self.waits = deque(maxlen=200)
+        self.service_times = deque(maxlen=50)
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_depth = 0
+
+    def resize(self, workers: int, max_queue: int, max_wait: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        while self.active < self.workers and self._hand_over():
+            self.active += 1
+
+    def eta(self, position: int) -> float:
+        """
+        Rough seconds until the user at this position in the queue starts
+        """
+        average = sum(self.service_times) / len(self.service_times) if self.service_times else 5
+        return position * average / self.workers
+
+    def wait_percentiles(self, *points) -> list:
+        waits = sorted(self.waits)
+        if not waits:
+            return [0.0 for _ in points]
+        return [waits[min(len(waits) - 1, int(len(waits) * point / 100))] for point in points]
+
+    @asynccontextmanager
+    async def admit(self, on_queued=None):
+        """
+        async with queue.admit(): wait for a slot, run while holding it
+
+        If the caller has to wait, on_queued is awaited with its position in the queue as it joins, so what the user is
+        told is where they actually are. Raises QueueFull if the queue is full, or QueueTimeout if no slot frees up within
+        max_wait
+        """
+        start = time.monotonic()
+        if self.active < self.workers and not self.waiting:
+            self.active += 1
+        else:
+            if len(self.waiting) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull()
+            slot = asyncio.get_event_loop().create_future()
+            self.waiting.append(slot)
+            self.peak_depth = max(self.peak_depth, len(self.waiting))
+            try:
+                if on_queued is not None:
+                    await on_queued(len(self.waiting))
+                await asyncio.wait_for(slot, max(0, self.max_wait - (time.monotonic() - start)))
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                self._leave(slot)
+                raise QueueTimeout() from None
+            except BaseException:
+                self._leave(slot)
+                raise
+
+        self.admitted += 1
+        admitted = time.monotonic()
+        self.waits.append(admitted - start)
+        try:
+            yield
+        finally:
+            self.service_times.append(time.monotonic() - admitted)
+            self.release()
+
+    def _leave(self, slot):
+        if slot.done() and not slot.cancelled():
+            # We were handed a slot just as we gave up, pass it on
+            self.release()
+        else:
+            try:
+                self.waiting.remove(slot)
+            except ValueError:
+                pass
+
+    def _hand_over(self) -> bool:
+        while self.waiting:
+            slot = self.waiting.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return True
+        return False
+
+    def release(self):
+        # Pass the slot on, unless workers was lowered and there are more running than it allows
+        if self.active > self.workers or not self._hand_over():
+            self.active -= 1
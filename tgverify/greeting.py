@@ -0,0 +1,26 @@
+"""
+Welcome greetings, parsed once when they are configured instead of on every join
+"""
+import string
+
+class Greeting:
+    """
+    A greeting template in str.format style, {0} is the joining member and {1} the guild
+
+    The suffix (the bunker warning) is appended as plain text, braces in it are not format fields. A template without
+    any fields is rendered once up front and every join gets the same string
+    """
+    def __init__(self, template: str, suffix: str = ""):
+        if suffix:
+            template = f"{template} " + suffix.replace("{", "{{").replace("}", "}}")
+        # Raises ValueError for a malformed template, so setters can reject it before it is saved
+        parts = list(string.Formatter().parse(template))
+        self.template = template
+        self.constant = None
+        if all(field is None for _, field, _, _ in parts):
+            self.constant = "".join(literal for literal, _, _, _ in parts)
+
+    def render(self, member, guild) -> str:
+        if self.constant is not None:
+            return self.constant
+        return self.template.format(member, guild)
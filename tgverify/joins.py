@@ -0,0 +1,63 @@
+"""
+Join rate tracking and batched welcomes, so a raid gets a few welcome messages instead of one per member
+"""
+import time
+from collections import deque
+
+class JoinRate:
+    """
+    Joins seen in a guild over the last minute, and running totals for [p]tgverify config current
+    """
+    def __init__(self):
+        self.recent = deque()
+        self.total = 0
+        self.batched = 0
+        self.messages = 0
+        self.peak = 0
+
+    def record(self) -> int:
+        """
+        Count a join, returns the joins in the last minute including it
+        """
+        now = time.monotonic()
+        self.recent.append(now)
+        self.total += 1
+        rate = self.per_minute(now)
+        self.peak = max(self.peak, rate)
+        return rate
+
+    def per_minute(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        while self.recent and self.recent[0] < now - 60:
+            self.recent.popleft()
+        return len(self.recent)
+
+class MemberGroup:
+    """
+    Stands in for the member when a greeting welcomes several at once, {0} and any {0.attribute} the greeting uses
+    become the members' values joined with commas
+    """
+    def __init__(self, members: list):
+        self.members = members
+
+    def __str__(self):
+        return ", ".join(str(member) for member in self.members)
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+    def __getattr__(self, name):
+        return ", ".join(str(getattr(member, name)) for member in self.members)
+
+def render_group(greeting, members: list, guild) -> str:
+    """
+    Render a greeting welcoming several members at once
+
+    MemberGroup attributes are strings, so a nested field ({0.guild.name}) or a format spec on one ({0.name:>10}) can't
+    be applied to them. Those greetings are rendered for the first member instead, with the rest mentioned after it
+    """
+    try:
+        return greeting.render(MemberGroup(members), guild)
+    except (AttributeError, TypeError, ValueError, KeyError, IndexError):
+        others = " ".join(member.mention for member in members[1:])
+        return f"{greeting.render(members[0], guild)} {others}".rstrip()
@@ -1,5 +1,7 @@
 #Standard Imports
+import asyncio
 import logging
+from collections import namedtuple
 from typing import Union
 
 #Discord Imports
@@ -7,11 +9,16 @@ import discord
 
 #Redbot Imports
 from redbot.core import commands, checks, Config
+from redbot.core.utils.menus import menu, DEFAULT_CONTROLS
 
 from tgcommon.errors import TGRecoverableError, TGUnrecoverableError
 from tgcommon.util import normalise_to_ckey
 from typing import cast
 
+from .admission import AdmissionQueue, QueueFull, QueueTimeout
+from .greeting import Greeting
+from .joins import JoinRate, render_group
+
 __version__ = "1.1.0"
 __author__ = "oranges"
 
@@ -19,6 +26,12 @@ log = logging.getLogger("red.oranges_tgverify")
 
 BaseCog = getattr(commands, "Cog", object)
 
+# Linked accounts shown per page of the discords listing, and how many pages we read before giving up
+DISCORDS_PER_PAGE = 10
+MAX_DISCORDS_PAGES = 20
+# Welcome messages sent for one batch window, members past these pages are only counted
+MAX_WELCOME_PAGES = 5
+
 class TGverify(BaseCog):
     """
     Connector that will integrate with any database using the latest tg schema, provides utility functionality
@@ -26,7 +39,8 @@ class TGverify(BaseCog):
     def __init__(self, bot):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=672261474290237490, force_registration=True)
-        self.visible_config = ["min_living_minutes", "verified_role", "instructions_link", "welcomegreeting", "disabledgreeting", "bunkerwarning", "bunker", "welcomechannel"]
+        self.visible_config = ["min_living_minutes", "verified_role", "instructions_link", "welcomegreeting", "disabledgreeting", "bunkerwarning", "bunker", "welcomechannel",
+        "welcome_batch_threshold", "welcome_batch_window", "welcome_batch_mentions", "verify_workers", "verify_queue_size", "verify_max_wait"]
 
         default_guild = {
             "min_living_minutes": 60,
@@ -38,11 +52,67 @@ class TGverify(BaseCog):
             "bunker": False,
             "disabled": False,
             "welcomechannel": "",
+            # Above this many joins a minute, joins are welcomed together once per window, up to this many mentions a message
+            "welcome_batch_threshold": 10,
+            "welcome_batch_window": 10,
+            "welcome_batch_mentions": 20,
+            # Verifications run at once, how many more may queue behind them and for how many seconds
+            "verify_workers": 3,
+            "verify_queue_size": 50,
+            "verify_max_wait": 120,
         }
 
         self.config.register_guild(**default_guild)
-
-
+        # Immutable per guild snapshot of the config above, and the join greeting it produces, so a join reads no Config
+        self.GuildSettings = namedtuple('GuildSettings', default_guild)
+        self.guild_settings_cache = {}
+        self.greetings = {}
+        # guild id -> JoinRate, and the members waiting on the guild's batched welcome with the task that will send it
+        self.join_rates = {}
+        self.pending_welcomes = {}
+        self.welcome_tasks = {}
+        # guild id -> AdmissionQueue for verify
+        self.verify_queues = {}
+
+    def cog_unload(self):
+        for task in self.welcome_tasks.values():
+            task.cancel()
+
+    async def guild_settings(self, guild):
+        """
+        Return the settings snapshot for this guild, only touching Config if we have never seen the guild
+        """
+        settings = self.guild_settings_cache.get(guild.id)
+        if settings is None:
+            settings = await self.config.guild(guild).all()
+            settings = self.GuildSettings(**{k: settings[k] for k in self.GuildSettings._fields})
+            self.store_guild_settings(guild, settings)
+        return settings
+
+    def update_guild_settings(self, guild, **changes):
+        """
+        Swap in a new snapshot with the given fields changed, called by the setters after they write to Config
+        """
+        settings = self.guild_settings_cache.get(guild.id)
+        if settings is not None:
+            self.store_guild_settings(guild, settings._replace(**changes))
+
+    def store_guild_settings(self, guild, settings):
+        self.guild_settings_cache[guild.id] = settings
+        template = settings.disabledgreeting if settings.disabled else settings.welcomegreeting
+        suffix = settings.bunkerwarning if settings.bunker else ""
+        try:
+            self.greetings[guild.id] = Greeting(template, suffix)
+        except ValueError:
+            # Saved before greetings were checked, send it as it is written rather than failing every join
+            log.warning(f"The greeting for guild {guild.id} is not a valid template, sending it without formatting")
+            self.greetings[guild.id] = Greeting(template.replace("{", "{{").replace("}", "}}"), suffix)
+
+    def verify_queue(self, guild, settings):
+        queue = self.verify_queues.get(guild.id)
+        if queue is None:
+            queue = self.verify_queues[guild.id] = AdmissionQueue(settings.verify_workers, settings.verify_queue_size, settings.verify_max_wait)
+        return queue
 
     @commands.guild_only()
     @commands.group()
@@ -77,8 +147,53 @@ class TGverify(BaseCog):
                 embed.add_field(name=f"{k}:",value=v,inline=False)
             else:
                 embed.add_field(name=f"{k}:",value="`redacted`",inline=False)
+        rate = self.join_rates.get(ctx.guild.id, JoinRate())
+        mode = "batched" if ctx.guild.id in self.pending_welcomes else "individual"
+        embed.add_field(name="joins:", value=f"{rate.per_minute()} in the last minute (peak {rate.peak}), {rate.total} since load,"
+            f" {rate.batched} welcomed in batches, {rate.messages} welcome messages sent, welcoming: {mode}", inline=False)
+        queue = self.verify_queues.get(ctx.guild.id)
+        if queue is not None:
+            p50, p95 = queue.wait_percentiles(50, 95)
+            embed.add_field(name="verify queue:", value=f"{queue.active} verifying, {len(queue.waiting)} waiting (peak {queue.peak_depth}),"
+                f" {queue.admitted} admitted, {queue.rejected} turned away full, {queue.timed_out} timed out, wait p50 {p50:.1f}s p95 {p95:.1f}s", inline=False)
         await ctx.send(embed=embed)
 
+    @config.command()
+    async def verify_workers(self, ctx, workers: int, queue_size: int = 50, max_wait: int = 120):
+        """
+        Set how many verifications run at once, and how many users may wait behind them for up to max_wait seconds
+        """
+        try:
+            if workers < 1 or queue_size < 0 or max_wait < 1:
+                return await ctx.send("There has to be at least one worker and a max wait of at least a second")
+            await self.config.guild(ctx.guild).verify_workers.set(workers)
+            await self.config.guild(ctx.guild).verify_queue_size.set(queue_size)
+            await self.config.guild(ctx.guild).verify_max_wait.set(max_wait)
+            self.update_guild_settings(ctx.guild, verify_workers=workers, verify_queue_size=queue_size, verify_max_wait=max_wait)
+            self.verify_queue(ctx.guild, await self.guild_settings(ctx.guild)).resize(workers, queue_size, max_wait)
+            await ctx.send(f"{workers} verifications will run at once, with up to {queue_size} more waiting for up to {max_wait} seconds")
+
+        except (ValueError, KeyError, AttributeError):
+            await ctx.send("There was a problem setting the verify queue")
+
+    @config.command()
+    async def welcome_batching(self, ctx, threshold: int, window: int = 10, mentions: int = 20):
+        """
+        Welcome joins together once the guild sees more than threshold joins a minute
+
+        Joins within window seconds share one welcome message mentioning up to mentions members, more get further pages
+        """
+        try:
+            if threshold < 1 or window < 1 or mentions < 1:
+                return await ctx.send("The threshold, window and mentions all have to be at least 1")
+            await self.config.guild(ctx.guild).welcome_batch_threshold.set(threshold)
+            await self.config.guild(ctx.guild).welcome_batch_window.set(window)
+            await self.config.guild(ctx.guild).welcome_batch_mentions.set(mentions)
+            self.update_guild_settings(ctx.guild, welcome_batch_threshold=threshold, welcome_batch_window=window, welcome_batch_mentions=mentions)
+            await ctx.send(f"Above {threshold} joins a minute, joins in the same {window} seconds are welcomed together, {mentions} to a message")
+
+        except (ValueError, KeyError, AttributeError):
+            await ctx.send("There was a problem setting welcome batching")
 
     @config.command()
     async def living_minutes(self, ctx, min_living_minutes: int = None):
@@ -88,9 +203,11 @@ class TGverify(BaseCog):
         try:
             if min_living_minutes is None:
                 await self.config.guild(ctx.guild).min_living_minutes.set(0)
+                self.update_guild_settings(ctx.guild, min_living_minutes=0)
                 await ctx.send(f"Minimum living minutes required for verification removed!")
             else:
                 await self.config.guild(ctx.guild).min_living_minutes.set(min_living_minutes)
+                self.update_guild_settings(ctx.guild, min_living_minutes=min_living_minutes)
                 await ctx.send(f"Minimum living minutes required for verification set to: `{min_living_minutes}`")
 
         except (ValueError, KeyError, AttributeError):
@@ -103,6 +220,7 @@ class TGverify(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).instructions_link.set(instruction_link)
+            self.update_guild_settings(ctx.guild, instructions_link=instruction_link)
             await ctx.send(f"Instruction link set to: `{instruction_link}`")
 
         except (ValueError, KeyError, AttributeError):
@@ -115,7 +233,6 @@ class TGverify(BaseCog):
         If channel isn"t specified, the guild's default channel will be used
         """
         guild = ctx.message.guild
-        guild_settings = await self.config.guild(guild).welcomechannel()
         if channel is None:
             channel = ctx.message.channel
         if not channel.permissions_for(ctx.me).send_messages:
@@ -126,6 +243,7 @@ class TGverify(BaseCog):
             return
         guild_settings = channel.id
         await self.config.guild(guild).welcomechannel.set(guild_settings)
+        self.update_guild_settings(guild, welcomechannel=guild_settings)
         msg = "I will now send welcome messages to {channel}".format(channel=channel.mention)
         await channel.send(msg)
     
@@ -135,7 +253,10 @@ class TGverify(BaseCog):
         Sets the welcoming greeting
         """
         try:
+            # Raises ValueError for a malformed template
+            Greeting(welcomegreeting)
             await self.config.guild(ctx.guild).welcomegreeting.set(welcomegreeting)
+            self.update_guild_settings(ctx.guild, welcomegreeting=welcomegreeting)
             await ctx.send(f"Welcome greeting set to: `{welcomegreeting}`")
 
         except (ValueError, KeyError, AttributeError):
@@ -147,7 +268,9 @@ class TGverify(BaseCog):
         Sets the welcoming greeting when the verification system is disabled
         """
         try:
+            Greeting(disabledgreeting)
             await self.config.guild(ctx.guild).disabledgreeting.set(disabledgreeting)
+            self.update_guild_settings(ctx.guild, disabledgreeting=disabledgreeting)
             await ctx.send(f"Disabled greeting set to: `{disabledgreeting}`")
 
         except (ValueError, KeyError, AttributeError):
@@ -160,6 +283,7 @@ class TGverify(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).bunkerwarning.set(bunkerwarning)
+            self.update_guild_settings(ctx.guild, bunkerwarning=bunkerwarning)
             await ctx.send(f"Bunker warning set to: `{bunkerwarning}`")
 
         except (ValueError, KeyError, AttributeError):
@@ -174,6 +298,7 @@ class TGverify(BaseCog):
             bunker = await self.config.guild(ctx.guild).bunker()
             bunker = not bunker
             await self.config.guild(ctx.guild).bunker.set(bunker)
+            self.update_guild_settings(ctx.guild, bunker=bunker)
             if bunker:
                 await ctx.send(f"The bunker warning is now on")
             else:
@@ -191,6 +316,7 @@ class TGverify(BaseCog):
             disabled = await self.config.guild(ctx.guild).disabled()
             disabled = not disabled
             await self.config.guild(ctx.guild).disabled.set(disabled)
+            self.update_guild_settings(ctx.guild, disabled=disabled)
             if disabled:
                 await ctx.send(f"The verification system is now off")
             else:
@@ -210,9 +336,11 @@ class TGverify(BaseCog):
                 return await ctx.send(f"This is not a valid role for this discord!")
             if verified_role is None:
                 await self.config.guild(ctx.guild).verified_role.set(None)
+                self.update_guild_settings(ctx.guild, verified_role=None)
                 await ctx.send(f"No role will be set when the user verifies!")
             else:
                 await self.config.guild(ctx.guild).verified_role.set(verified_role)
+                self.update_guild_settings(ctx.guild, verified_role=verified_role)
                 await ctx.send(f"When a user meets minimum verification this role will be applied: `{verified_role}`")
 
         except (ValueError, KeyError, AttributeError):
@@ -227,18 +355,34 @@ class TGverify(BaseCog):
         ckey = normalise_to_ckey(ckey)
         message = await ctx.send("Collecting discord accounts for ckey....")
         async with ctx.typing():
-            embed=discord.Embed(color=await ctx.embed_color())
-            embed.set_author(name=f"Discord accounts historically linked to {str(ckey).title()}")
-            links = await tgdb.all_discord_links_for_ckey(ctx, ckey)
-            if len(links) <= 0:
+            pages = []
+            links = tgdb.iter_discord_links_for_ckey(ctx, ckey, batch_size=DISCORDS_PER_PAGE)
+            try:
+                async for batch in links:
+                    if len(pages) >= MAX_DISCORDS_PAGES:
+                        pages[-1].set_footer(text=f"Only the latest {len(pages) * DISCORDS_PER_PAGE} accounts are shown")
+                        break
+                    embed=discord.Embed(color=await ctx.embed_color())
+                    embed.set_author(name=f"Discord accounts historically linked to {str(ckey).title()}")
+                    names = ""
+                    for link in batch:
+                        names += f"User linked <@{link.discord_id}> on {link.timestamp}, current account: {link.validity}\n"
+                    embed.add_field(name="__Discord accounts__", value=names, inline=False)
+                    pages.append(embed)
+            finally:
+                # Hand the streaming connection back now rather than whenever the generator is collected
+                await links.aclose()
+
+            if len(pages) <= 0:
+                # Usually a typo, offer the ckeys that are close to what was asked for
+                suggestions = await tgdb.suggest_ckeys(ctx, ckey)
+                if suggestions:
+                    return await message.edit(content=f"No discord accounts found for this ckey, did you mean: {', '.join(suggestions)}?")
                 return await message.edit(content="No discord accounts found for this ckey")
 
-            names = ""
-            for link in links:
-                names += f"User linked <@{link.discord_id}> on {link.timestamp}, current account: {link.validity}\n"
-
-            embed.add_field(name="__Discord accounts__", value=names, inline=False)
-            await message.edit(content=None, embed=embed)
+        await message.edit(content=None, embed=pages[0])
+        if len(pages) > 1:
+            await menu(ctx, pages, DEFAULT_CONTROLS, message=message)
 
 
     @tgverify.command()
@@ -277,21 +421,21 @@ class TGverify(BaseCog):
                 message = await message.edit(content=f"This discord user has no ckey linked")
 
     #Now the only user facing command, so this has rate limiting across the sky
+    # Load across the guild is bounded by the verify queue (see verify_workers), not by a cooldown
     @commands.cooldown(2, 60, type=commands.BucketType.user)
-    @commands.cooldown(6, 60, type=commands.BucketType.guild)
-    @commands.max_concurrency(3, per=commands.BucketType.guild, wait=False)
     @commands.guild_only()
     @commands.command()
     async def verify(self, ctx, *, one_time_token: str = None):
         """
         Attempt to verify the user, based on the passed in one time code
-        This command is rated limited to two attempts per user every 60 seconds, and 6 attempts per entire discord every 60 seconds
+        This command is rated limited to two attempts per user every 60 seconds
+        Only a few verifications run at once, everyone else waits their turn in a queue
         """
         #Get the minimum required living minutes
-        min_required_living_minutes = await self.config.guild(ctx.guild).min_living_minutes()
-        instructions_link = await self.config.guild(ctx.guild).instructions_link()
-        role = await self.config.guild(ctx.guild).verified_role()
-        role = ctx.guild.get_role(role)
+        settings = await self.guild_settings(ctx.guild)
+        min_required_living_minutes = settings.min_living_minutes
+        instructions_link = settings.instructions_link
+        role = ctx.guild.get_role(settings.verified_role)
         tgdb = self.get_tgdb()
         ckey = None
 
@@ -306,42 +450,60 @@ class TGverify(BaseCog):
         if role in ctx.author.roles:
             return await ctx.send("You already are verified")
 
-        message = await ctx.send("Attempting to verify you....")
-        async with ctx.typing():
-
-            if one_time_token:
-                # Attempt to find the user based on the one time token passed in.
-                ckey = await tgdb.lookup_ckey_by_token(ctx, one_time_token)
-
-            # they haven't specified a one time token or it didn't match, see if we already have a linked ckey for the user id that is still valid
-            if ckey is None:
-                discord_link = await tgdb.discord_link_for_discord_id(ctx, ctx.author.id)
-                if(discord_link and discord_link.valid > 0):
-                    # we have a fast path, just reapply the linked role and bail
-                    await ctx.author.add_roles(role, reason="User has re-verified against their in game living minutes")
-                    return await message.edit(content=f"Congrats {ctx.author} your verification is complete")
-
-                raise TGRecoverableError(f"Sorry {ctx.author} it looks like we don't recognise this one use token or it has expired or you don't have a ckey linked to this discord account, go back into game and try generating one another! See {instructions_link} for more information. \n\nIf it's still failing after a few tries, ask for support from the verification team, ")
+        queue = self.verify_queue(ctx.guild, settings)
+        message = None
 
-            log.info(f"Verification request by {ctx.author.id}, for ckey {ckey}")
-            # Now look for the user based on the ckey
-            player = await tgdb.get_player_by_ckey(ctx, ckey)
+        async def queued(position):
+            nonlocal message
+            message = await ctx.send(f"Lots of people are verifying right now, you are number {position} in the queue, about {queue.eta(position):.0f} seconds to go....")
 
-            if player is None:
-                raise TGRecoverableError(f"Sorry {ctx.author} looks like we couldn't look up your user, ask the verification team for support!")
-
-            if player['living_time'] < min_required_living_minutes:
-                return await message.edit(content=f"Sorry {ctx.author} you only have {player['living_time']} minutes as a living player on our servers, and you require at least {min_required_living_minutes}! You will need to play more on our servers to access all the discord channels, see {instructions_link} for more information")
-
-            # clear any/all previous valid links for ckey or the discord id (in case they have decided to make a new ckey)
-            await tgdb.clear_all_valid_discord_links_for_ckey(ctx, ckey)
-            await tgdb.clear_all_valid_discord_links_for_discord_id(ctx, ctx.author.id)
-            # Record that the user is linked against a discord id
-            await tgdb.update_discord_link(ctx, one_time_token, ctx.author.id)
-            if role:
-                await ctx.author.add_roles(role, reason="User has verified against their in game living minutes")
-
-            return await message.edit(content=f"Congrats {ctx.author} your verification is complete", color=0xff0000)
+        try:
+            async with queue.admit(queued):
+                if message is None:
+                    message = await ctx.send("Attempting to verify you....")
+                else:
+                    await message.edit(content="Attempting to verify you....")
+                async with ctx.typing():
+
+                    if one_time_token:
+                        # Attempt to find the user based on the one time token passed in.
+                        ckey = await tgdb.lookup_ckey_by_token(ctx, one_time_token)
+
+                    # they haven't specified a one time token or it didn't match, see if we already have a linked ckey for the user id that is still valid
+                    if ckey is None:
+                        discord_link = await tgdb.discord_link_for_discord_id(ctx, ctx.author.id)
+                        if(discord_link and discord_link.valid > 0):
+                            # we have a fast path, just reapply the linked role and bail
+                            await ctx.author.add_roles(role, reason="User has re-verified against their in game living minutes")
+                            return await message.edit(content=f"Congrats {ctx.author} your verification is complete")
+
+                        raise TGRecoverableError(f"Sorry {ctx.author} it looks like we don't recognise this one use token or it has expired or you don't have a ckey linked to this discord account, go back into game and try generating one another! See {instructions_link} for more information. \n\nIf it's still failing after a few tries, ask for support from the verification team, ")
+
+                    log.info(f"Verification request by {ctx.author.id}, for ckey {ckey}")
+                    # Now look for the user based on the ckey
+                    player = await tgdb.get_player_by_ckey(ctx, ckey)
+
+                    if player is None:
+                        raise TGRecoverableError(f"Sorry {ctx.author} looks like we couldn't look up your user, ask the verification team for support!")
+
+                    if player.living_time < min_required_living_minutes:
+                        return await message.edit(content=f"Sorry {ctx.author} you only have {player.living_time} minutes as a living player on our servers, and you require at least {min_required_living_minutes}! You will need to play more on our servers to access all the discord channels, see {instructions_link} for more information")
+
+                    # clear any/all previous valid links for ckey or the discord id (in case they have decided to make a new ckey)
+                    # and record that the user is linked against a discord id, all in one transaction
+                    if not await tgdb.complete_verification(ctx, ckey, one_time_token, ctx.author.id):
+                        raise TGRecoverableError(f"Sorry {ctx.author} it looks like your one use token was used or expired while we were verifying you, go back into game and generate another! See {instructions_link} for more information.")
+                    if role:
+                        await ctx.author.add_roles(role, reason="User has verified against their in game living minutes")
+
+                    return await message.edit(content=f"Congrats {ctx.author} your verification is complete", color=0xff0000)
+        except QueueFull:
+            # The attempt never ran, so it shouldn't count against the user
+            ctx.command.reset_cooldown(ctx)
+            raise TGRecoverableError(f"Sorry {ctx.author} the verification queue is full right now, try again in a minute")
+        except QueueTimeout:
+            ctx.command.reset_cooldown(ctx)
+            raise TGRecoverableError(f"Sorry {ctx.author} the verification queue didn't get to you in time, try again in a minute")
 
     @verify.error
     async def verify_error(self, ctx, error):
@@ -350,11 +512,6 @@ class TGverify(BaseCog):
             embed=discord.Embed(title=f"Error attempting to verify you:", description=f"{format(error)}", color=0xff0000)
             await ctx.send(content=f"", embed=embed)
 
-        elif isinstance(error, commands.MaxConcurrencyReached):
-            embed=discord.Embed(title=f"There are too many verifications in process, try again in 30 seconds:", description=f"{format(error)}", color=0xff0000)
-            await ctx.send(content=f"", embed=embed)
-            log.exception(f"Too many users attempting to verify concurrently, db wait hit?")
-
         elif isinstance(error, commands.CommandOnCooldown):
             embed=discord.Embed(title=f"Hey slow down buddy:", description=f"{format(error)}", color=0xff0000)
             await ctx.send(content=f"", embed=embed)
@@ -387,8 +544,8 @@ class TGverify(BaseCog):
         guild = member.guild
         if guild is None:
             return
-        channel_id = await self.config.guild(guild).welcomechannel()
-        channel = cast(discord.TextChannel, guild.get_channel(channel_id))
+        settings = await self.guild_settings(guild)
+        channel = cast(discord.TextChannel, guild.get_channel(settings.welcomechannel))
         if channel is None:
             log.info(f"tgverify channel not found for guild, it was probably deleted User joined: {member}")
             return
@@ -398,19 +555,49 @@ class TGverify(BaseCog):
             log.info(f"Bot doesn't have permissions to send messages to {guild.name}'s #{channel.name} channel")
             return
         
-        final = ""
-        if await self.config.guild(guild).disabled():
-            msg = await self.config.guild(guild).disabledgreeting()
-            final = msg.format(member, guild)
-        else:
-            msg = await self.config.guild(guild).welcomegreeting()
-            final = msg.format(member, guild)
-        bunkermsg = await self.config.guild(guild).bunkerwarning()
-        bunker = await self.config.guild(guild).bunker()
-        if bunkermsg != "" and bunker:
-            final = final + " " + bunkermsg
-        
-        await channel.send(final)
+        rate = self.join_rates.setdefault(guild.id, JoinRate())
+        joins_per_minute = rate.record()
+        pending = self.pending_welcomes.get(guild.id)
+        if pending is None and joins_per_minute <= settings.welcome_batch_threshold:
+            rate.messages += 1
+            return await channel.send(self.greetings[guild.id].render(member, guild))
+
+        # A raid or a big advertising push, collect everyone joining in the window into one welcome
+        rate.batched += 1
+        if pending is None:
+            pending = self.pending_welcomes[guild.id] = []
+            self.welcome_tasks[guild.id] = self.bot.loop.create_task(self.send_batched_welcomes(guild, channel, settings))
+        pending.append(member)
+
+    async def send_batched_welcomes(self, guild, channel, settings):
+        """
+        Wait out the batch window, then welcome everyone who joined in it, settings.welcome_batch_mentions members a message
+        """
+        try:
+            await asyncio.sleep(settings.welcome_batch_window)
+        finally:
+            members = self.pending_welcomes.pop(guild.id, [])
+            self.welcome_tasks.pop(guild.id, None)
+
+        size = settings.welcome_batch_mentions
+        pages = [members[i:i + size] for i in range(0, len(members), size)]
+        greeting = self.greetings[guild.id]
+        rate = self.join_rates[guild.id]
+        for number, page in enumerate(pages[:MAX_WELCOME_PAGES], 1):
+            try:
+                content = render_group(greeting, page, guild)
+            except Exception:
+                # Nobody in the window gets welcomed otherwise, and the task would die without a trace
+                log.exception(f"Could not render the batched welcome for {guild.name}, mentioning the members instead")
+                content = " ".join(member.mention for member in page)
+            if number == MAX_WELCOME_PAGES and len(pages) > MAX_WELCOME_PAGES:
+                content += f"\n...and {len(members) - MAX_WELCOME_PAGES * size} more"
+            try:
+                await channel.send(content)
+                rate.messages += 1
+            except discord.HTTPException:
+                log.exception(f"Could not send a batched welcome to {guild.name}'s #{channel.name} channel")
+                return
     
     def get_tgdb(self):
         tgdb = self.bot.get_cog("TGDB")